@@ -1,38 +1,71 @@
 import cv2
 import math
 
-from algorithms.basic_lsb import lsb_basic_hide, lsb_basic_reveal
-from algorithms.variable_rate_lsb import lsb_vr_count_available_bits, lsb_vr_hide, lsb_vr_reveal
+from algorithms.basic_lsb import lsb_basic_hide, lsb_basic_reveal, lsb_basic_reveal_region
+from algorithms.variable_rate_lsb import lsb_vr_plan, lsb_vr_hide, lsb_vr_reveal, lsb_vr_reveal_region, lsb_vr_capacity_sweep
 from algorithms.coverless import hide_data
+from algorithms.progress import report
 
 
-def lsb_basic_hide_wrapper(im1, im2, color_proportion):
+def lsb_basic_hide_wrapper(im1, im2, color_proportion, progress=None):
     bit_fraction_used = sum(color_proportion)/24
     new_x, new_y = int(im1.shape[0] * math.sqrt(bit_fraction_used)), int(im1.shape[1] * math.sqrt(bit_fraction_used))
     im2 = cv2.resize(im2.copy(), (new_x, new_y))
+    report(progress, 0.5)
 
-    return lsb_basic_hide(im1, im2, color_proportion)
+    result = lsb_basic_hide(im1, im2, color_proportion)
+    report(progress, 1)
+    return result
 
-def lsb_basic_reveal_wrapper(im, color_proportion):
+def lsb_basic_reveal_wrapper(im, color_proportion, progress=None):
     bit_fraction_used = sum(color_proportion)/24
     hidden_shape = int(im.shape[0] * math.sqrt(bit_fraction_used)), int(im.shape[1] * math.sqrt(bit_fraction_used)), im.shape[2]
 
-    return lsb_basic_reveal(im, hidden_shape, color_proportion)
+    result = lsb_basic_reveal(im, hidden_shape, color_proportion)
+    report(progress, 1)
+    return result
 
-def lsb_vr_hide_wrapper(im1, im2, alpha, max_p):
-    bit_fraction_used = lsb_vr_count_available_bits(im1, alpha, max_p) / (im1.shape[0] * im1.shape[1] * im1.shape[2] * 8)
-    new_x, new_y = int(im1.shape[0] * math.sqrt(bit_fraction_used)), int(im1.shape[1] * math.sqrt(bit_fraction_used))
+def lsb_basic_reveal_region_wrapper(im, color_proportion, rows=slice(None), cols=slice(None)):
+    bit_fraction_used = sum(color_proportion)/24
+    hidden_shape = int(im.shape[0] * math.sqrt(bit_fraction_used)), int(im.shape[1] * math.sqrt(bit_fraction_used)), im.shape[2]
+
+    return lsb_basic_reveal_region(im, hidden_shape, rows, cols, color_proportion)
+
+def lsb_vr_hidden_shape(cover_shape, available_bits):
+    bit_fraction_used = available_bits / (cover_shape[0] * cover_shape[1] * cover_shape[2] * 8)
+    return int(cover_shape[0] * math.sqrt(bit_fraction_used)), int(cover_shape[1] * math.sqrt(bit_fraction_used)), cover_shape[2]
+
+def lsb_vr_sweep_wrapper(im, alphas, max_ps):
+    # (alpha, max_p, available bits, hidden image shape) for every pair, computed from one pass over the image
+    capacities = lsb_vr_capacity_sweep(im, alphas, max_ps)
+    return [(alpha, max_p, int(c), lsb_vr_hidden_shape(im.shape, c)) for alpha, max_p, c in zip(alphas, max_ps, capacities)]
+
+def lsb_vr_hide_wrapper(im1, im2, alpha, max_p, processes=None, progress=None):
+    plan = lsb_vr_plan(im1, alpha, max_p)
+    new_x, new_y, _ = lsb_vr_hidden_shape(im1.shape, plan.total_bits)
     im2 = cv2.resize(im2.copy(), (new_x, new_y))
+    report(progress, 0.5)
 
-    return lsb_vr_hide(im1, im2, alpha, max_p)
+    result = lsb_vr_hide(im1, im2, alpha, max_p, plan=plan, processes=processes)
+    report(progress, 1)
+    return result
 
-def lsb_vr_reveal_wrapper(im, alpha, max_p):
-    bit_fraction_used = lsb_vr_count_available_bits(im, alpha, max_p) / (im.shape[0] * im.shape[1] * im.shape[2] * 8)
-    hidden_shape = int(im.shape[0] * math.sqrt(bit_fraction_used)), int(im.shape[1] * math.sqrt(bit_fraction_used)), im.shape[2]
+def lsb_vr_reveal_wrapper(im, alpha, max_p, processes=None, progress=None):
+    plan = lsb_vr_plan(im, alpha, max_p)
+    hidden_shape = lsb_vr_hidden_shape(im.shape, plan.total_bits)
+    report(progress, 0.5)
+
+    result = lsb_vr_reveal(im, hidden_shape, alpha, max_p, plan=plan, processes=processes)
+    report(progress, 1)
+    return result
+
+def lsb_vr_reveal_region_wrapper(im, alpha, max_p, rows=slice(None), cols=slice(None)):
+    plan = lsb_vr_plan(im, alpha, max_p)
+    hidden_shape = lsb_vr_hidden_shape(im.shape, plan.total_bits)
 
-    return lsb_vr_reveal(im, hidden_shape, alpha, max_p)
+    return lsb_vr_reveal_region(im, hidden_shape, rows, cols, alpha, max_p, plan=plan)
 
-def coverless_hide_data_wrapper(image, data, cache, progress_queue):
+def coverless_hide_data_wrapper(image, data, cache, progress_queue=None, eps=0):
     result_im = image.copy()
-    hide_data(result_im, data, cache, progress_queue)
+    hide_data(result_im, data, cache, progress_queue, eps)
     return result_im
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def bit_offsets(p):
+    ends = np.cumsum(p, dtype=np.int64)
+    return ends - p, ends
+
+def used_bytes(starts, bits_len):
+    return int(np.count_nonzero(starts < bits_len)) # Offsets are non-decreasing, so used bytes form a prefix
+
+def pad_bits(bits):
+    return np.concatenate((bits, np.zeros(8, dtype=np.uint8))) # Groups crossing the end of the secret are zero filled
+
+def write_planes(values, p, starts, bits):
+    # values - uint8 cover bytes (modified in place), p - number of LSBits used in each byte,
+    # starts - offset of the first bit of each byte in bits, MSB of every p-bit group goes first
+    if len(p) == 0:
+        return
+    chunk = values & ((0xFF << p) & 0xFF).astype(np.uint8) # Wipe p LSBits from every byte
+    for j in range(int(p.max())):
+        sel = p > j
+        chunk[sel] |= bits[starts[sel] + j] << (p[sel] - 1 - j) # j-th bit of the group goes to (p-1-j)-th LSB
+    values[:] = chunk
+
+def read_planes(values, p, starts, out):
+    if len(p) == 0:
+        return
+    for j in range(int(p.max())):
+        sel = p > j
+        out[starts[sel] + j] = (values[sel] >> (p[sel] - 1 - j)) & 1
+
+def trim_bits(bits, capacity, bits_len):
+    available = min(capacity, bits_len)
+    available -= available % 8 # Incomplete trailing byte is never written
+    bits[available:] = 0
+    return bits[:bits_len]
+
+def embed_bits(values, p, bits, starts=None):
+    p = np.asarray(p, dtype=np.uint8)
+    if starts is None:
+        starts, _ = bit_offsets(p)
+    used = used_bytes(starts, len(bits))
+    write_planes(values[:used], p[:used], starts[:used], pad_bits(bits))
+    return values
+
+def extract_bits(values, p, bits_len, starts=None):
+    p = np.asarray(p, dtype=np.uint8)
+    if starts is None:
+        starts, _ = bit_offsets(p)
+    used = used_bytes(starts, bits_len)
+    bits = np.zeros(bits_len + 8, dtype=np.uint8)
+    read_planes(values[:used], p[:used], starts[:used], bits)
+    capacity = int(starts[used - 1]) + int(p[used - 1]) if used else 0
+    return trim_bits(bits, capacity, bits_len)
+
+def bits_to_image(bits, shape):
+    return np.packbits(bits).reshape(shape)
+
+def region_bit_indices(hidden_shape, rows, cols):
+    # Secret bits of the pixels selected by rows and cols (slices or index arrays), shaped (rows, cols, channels, 8)
+    h2, w2, d2 = hidden_shape
+    rows, cols = np.arange(h2)[rows], np.arange(w2)[cols]
+    byte_indices = (rows[:, None, None] * w2 + cols[None, :, None]) * d2 + np.arange(d2)
+    return byte_indices[..., None] * 8 + np.arange(8)
+
+def locate_bits(p, starts, bit_indices):
+    # Cover byte holding each secret bit and the LSBit position of the bit in that byte
+    i = np.searchsorted(starts, bit_indices, side='right') - 1
+    return i, p[i].astype(np.int64) - 1 - (bit_indices - starts[i])
+
+def read_located_bytes(values, located, bit_indices, capacity):
+    i, shift = located
+    valid = bit_indices < capacity - capacity % 8 # Incomplete trailing byte is never written
+    i, shift = np.minimum(i, len(values) - 1), np.where(valid, shift, 0)
+    bits = np.where(valid, (values[i] >> shift) & 1, 0).astype(np.uint8)
+    return np.packbits(bits, axis=-1)[..., 0]
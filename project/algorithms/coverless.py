@@ -1,158 +1,532 @@
 import cv2
-import re
-
+import json
+import numpy as np
+import os
+import pathlib
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+from scipy.spatial import cKDTree
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+from algorithms.shared_arrays import share_array, attach_array, release
+from algorithms.progress import report
+
+
+LBP_WEIGHTS = np.array([
+    [2, 1, 128],
+    [4, 0, 64],
+    [8, 16, 32]
+]) # Weights of the neighbours in a block, block[a][b] = image[x-1+a][y-1+b] for the block centered at (x, y)
+
+LENGTH_HEADER_BITS = 32
+HASH_BAND_BLOCKS = 2048 # Blocks hashed at once by a streaming reveal
+BLOCK_STORE_VERSION = 2
+BLOCKS_CACHE_DIR = ".blocks_cache" # Created inside the blocks directory, skipped when listing block files
+BLOCKS_CACHE_MAX_BLOCKS = 2_000_000 # Default budget of the front ends, about 200 MB including the search tree
+ATTACHED_CACHES_LIMIT = 2
+_attached_caches = OrderedDict()
+
+
+class BlockIndex:
+    # Packed (N, 9) uint8 blocks of a single hash class, block[a][b] is stored at column 3*a + b.
+    # The KD-tree over them is built on first query and never pickled, so the index is cheap to send to other processes
+    def __init__(self, blocks):
+        self.blocks = np.ascontiguousarray(blocks, dtype=np.uint8).reshape(-1, 9)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getstate__(self):
+        return {"blocks": self.blocks}
+
+    def __setstate__(self, state):
+        self.__init__(state["blocks"])
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.blocks) # Nearest neighbour in 9-D is the minimum MSE block
+        return self._tree
+
+
+class SharedBlockCache(NamedTuple):
+    # Picklable handle of a block cache published into shared memory, passed to workers instead of the cache itself
+    handles: tuple # SharedArrayHandle of the packed blocks of hash 0 and hash 1
+
+
+def publish_block_cache(cache):
+    # Returned shared memory segments have to be kept by the publisher and released with unlink=True when no longer used
+    shms, handles = [], []
+    for hash in (0, 1):
+        shm, view, handle = share_array(cache[hash].blocks)
+        del view
+        shms.append(shm)
+        handles.append(handle)
+    return shms, SharedBlockCache(tuple(handles))
+
+
+def attach_block_cache(shared_cache):
+    # Attached once per process, so the KD-trees are also built only once per worker
+    key = tuple(handle.name for handle in shared_cache.handles)
+    if key in _attached_caches:
+        _attached_caches.move_to_end(key)
+        return _attached_caches[key][1]
+
+    shms, arrays = zip(*map(attach_array, shared_cache.handles))
+    cache = {hash: BlockIndex(arrays[hash]) for hash in (0, 1)}
+    _attached_caches[key] = (shms, cache)
+    while len(_attached_caches) > ATTACHED_CACHES_LIMIT:
+        old_shms, old_cache = _attached_caches.popitem(last=False)[1]
+        del old_cache
+        try:
+            for shm in old_shms:
+                release(shm)
+        except BufferError: # Still referenced by a running hide, the mapping is freed with the process
+            pass
+    return cache
 
-def get_block_with_hash(image, x, y):
-    center_value = image[x][y][0]
 
-    def to_bit(pixel_value):
-        if pixel_value >= center_value:
-            return 1
-        else:
+def get_block_cache(cache):
+    return attach_block_cache(cache) if isinstance(cache, SharedBlockCache) else cache
+
+
+def block_keys(blocks):
+    # 72-bit keys of packed blocks as (high 64 bits, low 8 bits), ordering by them is the lexicographic order of blocks
+    blocks = np.ascontiguousarray(blocks, dtype=np.uint8).reshape(-1, 9)
+    return blocks[:, :8].copy().view(">u8")[:, 0], blocks[:, 8]
+
+
+def unique_block_indices(blocks):
+    high, low = block_keys(blocks)
+    order = np.lexsort((low, high))
+    high, low = high[order], low[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (high[1:] != high[:-1]) | (low[1:] != low[:-1])
+    return order[first]
+
+
+class BlockCache(dict):
+    # Block indices by hash together with the size budget used to build them and the number of unique blocks left out
+    def __init__(self, indices, max_blocks=None, evicted=0):
+        super().__init__(indices)
+        self.max_blocks = max_blocks
+        self.evicted = evicted
+
+    @property
+    def stats(self):
+        size = sum(len(index) for index in self.values())
+        return {
+            "blocks": size,
+            "max_blocks": self.max_blocks,
+            "fill_level": size / self.max_blocks if self.max_blocks else None,
+            "evicted": self.evicted,
+        }
+
+
+def block_buckets(blocks, hashes):
+    # Coarse cells of the block space: hash, mean level and directions of the horizontal and vertical gradients
+    blocks = blocks.astype(np.int32)
+    mean_level = blocks.sum(axis=1) // (9 * 32)
+    horizontal = blocks[:, [2, 5, 8]].sum(axis=1) > blocks[:, [0, 3, 6]].sum(axis=1)
+    vertical = blocks[:, [6, 7, 8]].sum(axis=1) > blocks[:, [0, 1, 2]].sum(axis=1)
+    return hashes.astype(np.int64) * 32 + mean_level * 4 + horizontal * 2 + vertical
+
+
+def block_priorities(blocks):
+    # Pseudo-random, but fixed for a given block, so sampling does not depend on the order of files
+    high, low = block_keys(blocks)
+    x = high * np.uint64(0x9E3779B97F4A7C15) ^ (low.astype(np.uint64) + np.uint64(1)) * np.uint64(0xC2B2AE3D27D4EB4F)
+    x ^= x >> np.uint64(31)
+    return x * np.uint64(0xBF58476D1CE4E5B9)
+
+
+def bucket_caps(sizes, budget):
+    # Largest equal cap for all buckets which fits the budget, buckets smaller than the cap are kept whole
+    if sizes.sum() <= budget:
+        return sizes
+    sorted_sizes = np.sort(sizes)
+    kept = 0
+    for i, size in enumerate(sorted_sizes):
+        cap = (budget - kept) // (len(sorted_sizes) - i)
+        if cap < size:
+            return np.minimum(sizes, cap)
+        kept += size
+    return sizes
+
+
+class DistinctCounter:
+    # HyperLogLog estimate of the number of distinct blocks, the registers depend only on the set of blocks seen,
+    # not on their order or repetitions, and take 64 KiB whatever the number of blocks
+    REGISTER_BITS = 16
+
+    def __init__(self):
+        self.registers = np.zeros(1 << self.REGISTER_BITS, dtype=np.uint8)
+
+    def add(self, blocks):
+        x = block_priorities(blocks)
+        rest_bits = 64 - self.REGISTER_BITS
+        rest = (x & np.uint64((1 << rest_bits) - 1)).astype(np.float64) # Exact, below 2 ** 53
+        ranks = rest_bits + 1 - np.frexp(rest)[1]
+        np.maximum.at(self.registers, (x >> np.uint64(rest_bits)).astype(np.intp), ranks.astype(np.uint8))
+
+    @property
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class BlockReservoir:
+    # Unique blocks limited to max_blocks. Each bucket keeps its lowest priority blocks, which is reservoir sampling
+    # within the bucket, and rare buckets are kept whole, so coverage of the block space is preserved
+    def __init__(self, max_blocks=None):
+        self.max_blocks = max_blocks
+        self.blocks = np.empty((0, 9), dtype=np.uint8)
+        self.hashes = np.empty(0, dtype=np.uint8)
+        self.pending = []
+        self.pending_len = 0
+        self.seen = DistinctCounter() if max_blocks is not None else None
+        self.any_evicted = False
+
+    def add(self, blocks, hashes):
+        self.pending.append((np.asarray(blocks, dtype=np.uint8).reshape(-1, 9), np.asarray(hashes, dtype=np.uint8)))
+        self.pending_len += len(hashes)
+        if self.max_blocks is not None and self.pending_len > max(self.max_blocks, 1_000_000):
+            self.compact()
+
+    def compact(self):
+        blocks = np.concatenate([self.blocks] + [b for b, _ in self.pending])
+        hashes = np.concatenate([self.hashes] + [h for _, h in self.pending])
+        self.pending, self.pending_len = [], 0
+        unique = unique_block_indices(blocks) # The hash is a function of the block, so blocks alone identify entries
+        blocks, hashes = blocks[unique], hashes[unique]
+        if self.seen is not None:
+            self.seen.add(blocks)
+
+        if self.max_blocks is not None and len(blocks) > self.max_blocks:
+            buckets = block_buckets(blocks, hashes)
+            order = np.lexsort((block_priorities(blocks), buckets))
+            sorted_buckets = buckets[order]
+            bucket_ids, bucket_starts, sizes = np.unique(sorted_buckets, return_index=True, return_counts=True)
+            ranks = np.arange(len(order)) - np.repeat(bucket_starts, sizes)
+            keep = np.sort(order[ranks < np.repeat(bucket_caps(sizes, self.max_blocks), sizes)])
+            self.any_evicted = True
+            blocks, hashes = blocks[keep], hashes[keep]
+
+        self.blocks, self.hashes = blocks, hashes
+
+    @property
+    def evicted(self):
+        # Unique blocks seen but not kept. Summing the evictions of every compaction would count a block again each time
+        # it comes back after being evicted, which depends on the order of files. Nothing is evicted exactly when
+        # all unique blocks fit in the budget, otherwise the number of unique blocks is estimated
+        if not self.any_evicted:
             return 0
-
-    block = (
-        (image[x-1][y+1][0], image[x][y+1][0], image[x+1][y+1][0]),
-        (image[x-1][y][0], image[x][y][0], image[x+1][y][0]),
-        (image[x-1][y-1][0], image[x][y-1][0], image[x+1][y-1][0])
-    )
-
-    bits = [to_bit(image[x - 1][y][0]),
-            to_bit(image[x - 1][y - 1][0]),
-            to_bit(image[x][y - 1][0]),
-            to_bit(image[x + 1][y - 1][0]),
-            to_bit(image[x + 1][y][0]),
-            to_bit(image[x + 1][y + 1][0]),
-            to_bit(image[x][y + 1][0]),
-            to_bit(image[x - 1][y + 1][0])]
-
-    lbp = 0
-    bit_values = [1, 2, 4, 8, 16, 32, 64, 128]
-    for i in range(len(bits)):
-        lbp += bits[i] * bit_values[i]
-
-    hash = 0
-    if center_value > lbp:
-        hash = 1
-    else:
-        hash = 0
-
-    return block, hash
-
-
-def build_block_cache(filenames, progress_queue):
-    cache = {
-        0: set(),
-        1: set()
-    }
-
+        return max(1, self.seen.count - len(self.blocks))
+
+    def build_cache(self):
+        self.compact()
+        return BlockCache({hash: BlockIndex(self.blocks[self.hashes == hash]) for hash in (0, 1)}, self.max_blocks, self.evicted)
+
+
+def get_file_blocks(filename):
+    blocks, hashes = get_blocks_with_hashes(cv2.imread(filename))
+    unique = unique_block_indices(blocks)
+    return blocks.reshape(-1, 9)[unique], hashes[unique]
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_raw(path, width):
+    size = os.path.getsize(path)
+    if size == 0:
+        return np.empty((0, width), dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, width)
+
+
+def load_block_store(cache_dir):
+    # Blocks of every file are appended as a segment of blocks.bin, the manifest maps files to their segments
+    cache_dir = pathlib.Path(cache_dir)
+    try:
+        with open(cache_dir / "manifest.json") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != BLOCK_STORE_VERSION:
+            raise ValueError("Unsupported blocks cache version")
+        blocks = load_raw(cache_dir / "blocks.bin", 9)
+        hashes = load_raw(cache_dir / "hashes.bin", 1)[:, 0]
+    except (OSError, ValueError):
+        return {"files": {}}, None, None
+    return manifest, blocks, hashes
+
+
+def load_block_cache(cache_dir, manifest):
+    try:
+        indices = {hash: BlockIndex(np.load(pathlib.Path(cache_dir) / f"index_{hash}.npy")) for hash in (0, 1)}
+    except (OSError, ValueError):
+        return None
+    return BlockCache(indices, manifest["max_blocks"], manifest["evicted"])
+
+
+@contextmanager
+def store_lock(cache_dir):
+    # Exclusive for a whole rebuild, the UI, batch.py and service.py may build from the same blocks directory at once
+    with open(pathlib.Path(cache_dir) / "lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX) # Released when the file is closed
+            yield
+            return
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1) # Gives up after 10 s
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def store_temp_file(cache_dir, name):
+    # Unique name, so a file being written is never shared, it is moved over name once complete
+    return tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f"{name}.", suffix=".tmp", delete=False)
+
+
+def save_block_cache(cache_dir, manifest, cache):
+    # Segment files are already written and the old manifest removed, manifest goes last, so a partial write is never treated as valid
+    cache_dir = pathlib.Path(cache_dir)
+    for name, save in (("index_0.npy", lambda f: np.save(f, cache[0].blocks)), ("index_1.npy", lambda f: np.save(f, cache[1].blocks)),
+                       ("manifest.json", lambda f: f.write(json.dumps(manifest).encode()))):
+        with store_temp_file(cache_dir, name) as f:
+            save(f)
+        os.replace(f.name, cache_dir / name)
+
+
+def get_files_blocks(filenames):
+    return [get_file_blocks(f) for f in filenames]
+
+
+def process_files(filenames, progress_queue=None, processes=None):
+    # Yields (filename, blocks, hashes), files are decoded and hashed in shards on a process pool
+    # and progress is reported once per shard
     files_len = len(filenames)
-    for i, f in enumerate(filenames):
-        progress_queue.put_nowait(i / files_len)
-        im = cv2.imread(f)
-        blocks_with_hashes = get_blocks_with_hashes(im)
-        for block, hash in blocks_with_hashes:
-            cache[hash].add(block)
-
+    if processes is None or processes < 2 or files_len < 2:
+        for i, f in enumerate(filenames):
+            report(progress_queue, i / files_len)
+            yield (f,) + get_file_blocks(f)
+        return
+
+    shard_size = max(1, min(64, files_len // (processes * 4)))
+    shards = [filenames[i:i + shard_size] for i in range(0, files_len, shard_size)]
+    done = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(get_files_blocks, shard): shard for shard in shards}
+        for future in as_completed(futures):
+            for f, result in zip(futures[future], future.result()):
+                yield (f,) + result
+            done += len(futures[future])
+            report(progress_queue, done / files_len)
+
+
+def build_block_cache(filenames, progress_queue=None, cache_dir=None, processes=None, max_blocks=None):
+    # With cache_dir only new or changed files are processed, unchanged ones are taken from the store on disk.
+    # With max_blocks at most that many unique blocks are kept in memory, see BlockReservoir
+    if cache_dir is None:
+        reservoir = BlockReservoir(max_blocks)
+        for f, blocks, hashes in process_files(filenames, progress_queue, processes):
+            reservoir.add(blocks, hashes)
+        return reservoir.build_cache()
+
+    try:
+        cache_dir = pathlib.Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with store_lock(cache_dir):
+            return build_stored_block_cache(filenames, progress_queue, cache_dir, processes, max_blocks)
+    except OSError:
+        # Store cannot be written, e.g. in a read-only blocks directory, so the cache is built in memory only
+        return build_block_cache(filenames, progress_queue, None, processes, max_blocks)
+
+
+def build_stored_block_cache(filenames, progress_queue, cache_dir, processes, max_blocks):
+    # Called with the store locked
+    for temp in cache_dir.glob("*.tmp"):
+        temp.unlink() # Left by a crashed build, nobody else writes while the lock is held
+    old_manifest, old_blocks, old_hashes = load_block_store(cache_dir)
+    old_files = old_manifest["files"]
+    signatures = {f: file_signature(f) for f in filenames}
+    unchanged = {f for f in filenames if f in old_files and all(old_files[f][k] == v for k, v in signatures[f].items())}
+    changed = set(old_files) != set(filenames) or len(unchanged) != len(filenames)
+
+    if not changed and old_manifest.get("max_blocks") == max_blocks:
+        cache = load_block_cache(cache_dir, old_manifest)
+        if cache is not None:
+            return cache
+
+    def segments():
+        for f in filenames:
+            if f in unchanged:
+                entry = old_files[f]
+                yield f, old_blocks[entry["start"]:entry["start"] + entry["count"]], old_hashes[entry["start"]:entry["start"] + entry["count"]]
+        yield from process_files([f for f in filenames if f not in unchanged], progress_queue, processes)
+
+    reservoir = BlockReservoir(max_blocks)
+    files = {}
+    start = 0
+    with store_temp_file(cache_dir, "blocks.bin") as blocks_file, store_temp_file(cache_dir, "hashes.bin") as hashes_file:
+        for f, blocks, hashes in segments():
+            blocks_file.write(np.ascontiguousarray(blocks).tobytes())
+            hashes_file.write(np.ascontiguousarray(hashes).tobytes())
+            reservoir.add(blocks, hashes)
+            files[f] = {**signatures[f], "start": start, "count": len(hashes)}
+            start += len(hashes)
+
+    reservoir.compact() # Drops references to segments of the old memory maps
+    del old_blocks, old_hashes # Memory maps have to be closed before the files are replaced
+    # Old manifest describes the old segment layout, it must not survive a crash while the segment files are replaced
+    (cache_dir / "manifest.json").unlink(missing_ok=True)
+    os.replace(blocks_file.name, cache_dir / "blocks.bin")
+    os.replace(hashes_file.name, cache_dir / "hashes.bin")
+    cache = reservoir.build_cache()
+    save_block_cache(cache_dir, {"version": BLOCK_STORE_VERSION, "max_blocks": max_blocks, "evicted": cache.evicted, "files": files}, cache)
     return cache
 
 
 def get_blocks_with_hashes(image):
+    # Blocks of the first channel in row-major order as an (N, 3, 3) array and their LBP hashes as an (N,) array
     height, width, _ = image.shape
     num_of_blocks_horizontal = width // 3
     num_of_blocks_vertical = height // 3
 
-    blocks_with_hashes = []
-    for i in range(num_of_blocks_horizontal):
-        for j in range(num_of_blocks_vertical):
-            x = i * 3 + 1
-            y = j * 3 + 1
-            block, hash = get_block_with_hash(image, x, y)
-            blocks_with_hashes.append((block, hash))
-
-    return blocks_with_hashes
+    blocks = image[:num_of_blocks_vertical * 3, :num_of_blocks_horizontal * 3, 0] \
+        .reshape(num_of_blocks_vertical, 3, num_of_blocks_horizontal, 3).transpose(0, 2, 1, 3).reshape(-1, 3, 3)
+    blocks = np.ascontiguousarray(blocks, dtype=np.uint8)
 
+    center_values = blocks[:, 1, 1].astype(np.int64)
+    lbp = ((blocks >= blocks[:, 1:2, 1:2]) * LBP_WEIGHTS).sum(axis=(1, 2))
+    hashes = (center_values > lbp).astype(np.uint8)
 
-def get_mse(block1, block2):
-    mse = 0
-    for i in range(3):
-        for j in range(3):
-            mse += (int(block1[i][j]) - int(block2[i][j]))**2
+    return blocks, hashes
 
-    return mse
 
+def get_blocks_for_substitution(blocks, hash, cache, eps=0):
+    # Minimum MSE replacement with the given hash for every block, one batched tree query.
+    # With eps > 0 tree cells which cannot hold a block closer than distance / (1 + eps) are skipped,
+    # so the found block is at most (1 + eps) times further than the exact one, trading quality for speed
+    index = cache[hash]
+    if len(index) == 0:
+        raise Exception(f"No blocks with hash {hash} in blocks cache")
 
-def get_block_for_substitution(block, hash, cache):
-    min_mse = 1_000_000_000
-    min_block = None
-    for candidate in cache[hash]:
-        candidate_mse = get_mse(block, candidate)
-        if candidate_mse < min_mse:
-            min_mse = candidate_mse
-            min_block = candidate
+    _, i = index.tree.query(np.asarray(blocks).reshape(-1, 9), eps=eps)
+    return index.blocks[i].reshape(-1, 3, 3)
 
-    return min_block
 
-
-def substitute_block(image, block, x, y): #x, y - center of block to be substituted
-    for color in range(3):
-        image[x-1][y+1][color] = block[0][0]
-        image[x][y+1][color] = block[0][1]
-        image[x+1][y+1][color] = block[0][2]
-        image[x-1][y][color] = block[1][0]
-        image[x][y][color] = block[1][1]
-        image[x+1][y][color] = block[1][2]
-        image[x-1][y-1][color] = block[2][0]
-        image[x][y-1][color] = block[2][1]
-        image[x+1][y-1][color] = block[2][2]
+def substitute_blocks(image, blocks, indices):
+    # Writes blocks over the row-major block indices in a single assignment
+    num_of_blocks_horizontal = image.shape[1] // 3
+    rows = (indices // num_of_blocks_horizontal * 3)[:, None] + np.arange(3)
+    cols = (indices % num_of_blocks_horizontal * 3)[:, None] + np.arange(3)
+    image[rows[:, :, None], cols[:, None, :], :3] = np.asarray(blocks, dtype=np.uint8)[:, :, :, None]
 
 
 def data_to_bit_array(data):
-    arr = data.encode()
-    res = []
-    for byte in arr:
-        for val in [1, 2, 4, 8, 16, 32, 64, 128]:
-            res.append(int((byte & val) > 0))
-
-    return res
-
+    # Payload prefixed with its length in bytes as a 32-bit little endian integer, every byte goes LSB first
+    if isinstance(data, str):
+        data = data.encode()
+    payload = np.frombuffer(len(data).to_bytes(LENGTH_HEADER_BITS // 8, "little") + bytes(data), dtype=np.uint8)
+    return np.unpackbits(payload, bitorder="little")
 
-def bit_array_to_data(bit_array):
-    res = []
-    for i in range(len(bit_array) // 8):
-        c = 0
-        for index, val in enumerate([1, 2, 4, 8, 16, 32, 64, 128]):
-            c += bit_array[i * 8 + index] * val
-        res.append(c)
 
-    tmp = str(bytearray(res))
-    m = re.search("(?<=^bytearray\(b\').*(?=\'\)$)", tmp)
-    return m.group(0)
+def header_to_length(bit_array):
+    return int.from_bytes(np.packbits(np.asarray(bit_array[:LENGTH_HEADER_BITS], dtype=np.uint8), bitorder="little").tobytes(), "little")
 
 
-def hide_data(image, data, cache, progress_queue):
+def hide_data(image, data, cache, progress_queue=None, eps=0):
     height, width, _ = image.shape
     num_of_blocks_horizontal = width // 3
     num_of_blocks_vertical = height // 3
     num_of_blocks = num_of_blocks_horizontal * num_of_blocks_vertical
 
-    if len(data) / 8 > num_of_blocks:
+    bit_array = data_to_bit_array(data)
+    if len(bit_array) > num_of_blocks:
         raise Exception(f"Image too small to hide data of size {len(data)}")
 
-    bit_array = data_to_bit_array(data)
-    bits_len = len(bit_array)
-    blocks_with_hashes = get_blocks_with_hashes(image)
-    for index, bit in enumerate(bit_array):
-        progress_queue.put_nowait(index / bits_len)
-        
-        block, hash = blocks_with_hashes[index]
-        if bit != hash:
-            block_for_substitution = get_block_for_substitution(block, bit, cache)
-            x = (index // num_of_blocks_horizontal) * 3 + 1
-            y = (index % num_of_blocks_horizontal) * 3 + 1
-            substitute_block(image, block_for_substitution, x, y)
+    cache = get_block_cache(cache)
+    blocks, hashes = get_blocks_with_hashes(image)
+    mismatched = np.flatnonzero(bit_array != hashes[:len(bit_array)])
+    new_blocks = np.empty((len(mismatched), 3, 3), dtype=np.uint8)
+    for hash in (0, 1):
+        report(progress_queue, hash / 2)
+        sel = bit_array[mismatched] == hash
+        if np.any(sel):
+            new_blocks[sel] = get_blocks_for_substitution(blocks[mismatched[sel]], hash, cache, eps)
+
+    substitute_blocks(image, new_blocks, mismatched)
+    report(progress_queue, 1)
+
+
+def get_psnr(image1, image2):
+    mse = np.mean((image1.astype(np.int32) - image2.astype(np.int32)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255 ** 2 / mse))
+
+
+def compare_approximate_search(image, data, cache, eps):
+    # PSNR and hide time of exact and approximate search, to pick eps for a given cache and payload
+    result = {}
+    for name, search_eps in (("exact", 0), ("approximate", eps)):
+        stego_image = image.copy()
+        start = time.perf_counter()
+        hide_data(stego_image, data, cache, None, search_eps)
+        result[name] = {"psnr": get_psnr(image, stego_image), "time": time.perf_counter() - start}
+    result["psnr_cost"] = result["exact"]["psnr"] - result["approximate"]["psnr"]
+    return result
+
+
+def iter_block_hashes(image):
+    # Hashes of the blocks in row-major order, computed lazily one band of block rows at a time
+    num_of_blocks_horizontal = image.shape[1] // 3
+    num_of_blocks_vertical = image.shape[0] // 3
+    rows_per_band = max(1, HASH_BAND_BLOCKS // max(num_of_blocks_horizontal, 1))
+    for row in range(0, num_of_blocks_vertical, rows_per_band):
+        _, hashes = get_blocks_with_hashes(image[row * 3:(row + rows_per_band) * 3])
+        yield hashes
+
+
+def iter_message(image):
+    # Yields payload bytes as soon as their blocks are hashed and stops once the length from the header is reached
+    pending = np.empty(0, dtype=np.uint8)
+    remaining = None
+    for hashes in iter_block_hashes(image):
+        pending = np.concatenate((pending, hashes))
+        if remaining is None:
+            if len(pending) < LENGTH_HEADER_BITS:
+                continue
+            remaining = header_to_length(pending) * 8
+            pending = pending[LENGTH_HEADER_BITS:]
+
+        ready = min(len(pending) - len(pending) % 8, remaining)
+        if ready > 0:
+            yield np.packbits(pending[:ready], bitorder="little").tobytes()
+            pending, remaining = pending[ready:], remaining - ready
+        if remaining == 0:
+            return
 
 
 def get_message(image):
-    hashes = list(map(lambda x: x[1], get_blocks_with_hashes(image)))
-    return bit_array_to_data(hashes)
+    return b"".join(iter_message(image))
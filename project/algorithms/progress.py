@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+
+from algorithms.shared_arrays import share_array, attach_array, release
+
+REPORT_INTERVAL = 0.1 # Seconds between two writes of the same reporter
+
+
+class ProgressReporter:
+    # Worker side of a ProgressChannel, picklable and used in place of a progress queue.
+    # Writes are throttled, so reporting per item of a loop is cheap
+    def __init__(self, handle, interval=REPORT_INTERVAL):
+        self.handle = handle
+        self.interval = interval
+        self.shm = None
+        self.values = None
+        self.last_report = 0
+
+    def __getstate__(self):
+        return {"handle": self.handle, "interval": self.interval}
+
+    def __setstate__(self, state):
+        self.__init__(state["handle"], state["interval"])
+
+    def __del__(self):
+        if self.shm is not None:
+            self.values = None
+            release(self.shm)
+
+    def put_nowait(self, fraction):
+        now = time.monotonic()
+        if now - self.last_report < self.interval and fraction < 1:
+            return
+        if self.shm is None:
+            try:
+                self.shm, self.values = attach_array(self.handle)
+            except FileNotFoundError:
+                self.interval = float("inf") # Channel was closed by its owner, the remaining reports are dropped
+                return
+        self.values[0] = fraction
+        self.last_report = now
+
+
+class ProgressChannel:
+    # Owner side, fraction of the done work kept in shared memory together with the start time
+    def __init__(self):
+        self.open()
+
+    def open(self):
+        self.shm, self.values, self.handle = share_array(np.zeros(2))
+
+    def reset(self):
+        # A closed channel is reopened, reporters made before it was closed keep dropping their reports
+        if self.values is None:
+            self.open()
+        self.values[:] = (0, time.time())
+
+    def reporter(self):
+        if self.values is None:
+            self.open()
+        return ProgressReporter(self.handle)
+
+    @property
+    def fraction(self):
+        return float(self.values[0]) if self.values is not None else 0.0
+
+    @property
+    def eta(self):
+        # Seconds left extrapolated from the rate so far, None until there is any progress
+        fraction = self.fraction
+        if fraction <= 0:
+            return None
+        return (time.time() - self.values[1]) * (1 - fraction) / fraction
+
+    def close(self):
+        # Bindings of a closed page may still read fraction and eta until the page is deleted
+        if self.values is None:
+            return
+        self.values = None
+        release(self.shm, unlink=True)
+
+
+def report(progress, fraction):
+    if progress is not None:
+        progress.put_nowait(fraction)
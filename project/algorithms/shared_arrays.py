@@ -0,0 +1,28 @@
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+
+class SharedArrayHandle(NamedTuple):
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def share_array(arr):
+    # Returned SharedMemory has to be kept alive by the caller, which is also responsible for unlinking it
+    arr = np.asarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[...] = arr
+    return shm, view, SharedArrayHandle(shm.name, arr.shape, arr.dtype.str)
+
+def attach_array(handle):
+    shm = shared_memory.SharedMemory(name=handle.name)
+    return shm, np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+
+def release(shm, unlink=False):
+    shm.close()
+    if unlink:
+        shm.unlink()
@@ -1,76 +1,164 @@
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
 import numpy as np
 
-def coords_from_ctr(ctr, h, w, d):
-    return ctr%8, ctr//8%d, ctr//(8*d)%w, ctr//(8*d*w)%h
+from algorithms.bit_planes import bit_offsets, used_bytes, pad_bits, write_planes, read_planes, trim_bits, \
+    embed_bits, extract_bits, bits_to_image, region_bit_indices, locate_bits, read_located_bytes
+from algorithms.shared_arrays import share_array, attach_array, release
 
-def lsb_vr_count_available_bits(im, alpha=9, max_p=4):
+PLAN_CACHE_SIZE = 8
+PLAN_CACHE_MAX_BYTES = 256 * 1024 * 1024 # A plan takes 9 bytes per cover byte, larger plans are not memoized
+_plan_cache = OrderedDict()
+
+
+class LsbVrPlan(NamedTuple):
+    total_bits: int
+    bits_map: np.ndarray # Bits used by each byte of the image, same shape as the image
+    starts: np.ndarray # Offset of the first secret bit stored in each byte, flat C order
+
+
+def lsb_vr_bits_table(alpha=9, max_p=4):
+    # Bits used for each possible neighbour XOR value, alpha and max_p may be equal length arrays giving one row per pair
+    x = np.arange(256)
+    alpha, max_p = np.asarray(alpha)[..., None], np.asarray(max_p)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bits = np.where(x > alpha, np.minimum(max_p, np.ceil(x / alpha)), 1)
+    return np.clip(bits, 0, 8).astype(np.uint8)
+
+def lsb_vr_checkerboard_xor(im):
+    # Neighbour XOR of the interior with the checkerboard mask of used pixels (odd row + col),
+    # neighbours of used pixels are never modified so the values are the same for cover and stego
     h1, w1, d1 = im.shape
+    x = im[:-2, 1:-1] ^ im[2:, 1:-1] ^ im[1:-1, :-2] ^ im[1:-1, 2:]
+    rows, cols = np.indices((max(h1 - 2, 0), max(w1 - 2, 0)))
+    checkerboard = (rows + cols) % 2 == 1 # Interior coordinates are shifted by one in both axes, so parity is kept
+    return x, checkerboard
 
-    result = 0
+def lsb_vr_bits_map(im, alpha=9, max_p=4):
+    h1, w1, d1 = im.shape
 
-    for row in range(1, h1 - 1):
-        for col in range(1 + row%2, w1 - 1, 2):
-            for d in range(d1):
-                x = im[row - 1, col, d] ^ im[row + 1, col, d] ^ im[row, col - 1, d] ^ im[row, col + 1, d]
-                result += min(max_p, int(np.ceil(x/alpha))) if x > alpha else 1
-    
-    return result
+    p = np.zeros(im.shape, dtype=np.uint8)
+    if h1 < 3 or w1 < 3:
+        return p
 
-def lsb_vr_hide(im1, im2, alpha=9, max_p=4):
-    h1, w1, d1 = im1.shape
-    h2, w2, d2 = im2.shape
-    
-    im3 = im1.copy()
-    
-    im2_ctr = 0
-    
-    for row in range(1, h1 - 1):
-        for col in range(1 + row%2, w1 - 1, 2):
-            for d in range(d1):
-                x = im1[row - 1, col, d] ^ im1[row + 1, col, d] ^ im1[row, col - 1, d] ^ im1[row, col + 1, d]
-                p = 1
-                if x > alpha:
-                    p = min(max_p, int(np.ceil(x/alpha)))
-
-                b = im3[row, col, d]
-                b = ((b>>p)<<p) # Wipe p LSBits from b
-                for j in range(p - 1, -1, -1):
-                    b2, z2, y2, x2 = coords_from_ctr(im2_ctr, h2, w2, d2)
-                    b = b | (((im2[x2, y2, z2]>>(7 - b2))&1)<<j) # Take b2-th MSB of im2 pixel and insert it at j-th LSB of b
-                    im2_ctr += 1
-                    if im2_ctr == h2*w2*d2*8:
-                        im3[row, col, d] = b
-                        return im3
-                im3[row, col, d] = b
-    return im3
-
-def lsb_vr_reveal(im, hidden_shape, alpha=9, max_p=4):
+    x, checkerboard = lsb_vr_checkerboard_xor(im)
+    p[1:-1, 1:-1][checkerboard] = lsb_vr_bits_table(alpha, max_p)[x[checkerboard]]
+    return p
+
+def lsb_vr_xor_histogram(im):
     h1, w1, d1 = im.shape
+    if h1 < 3 or w1 < 3:
+        return np.zeros(256, dtype=np.int64)
+
+    x, checkerboard = lsb_vr_checkerboard_xor(im)
+    return np.bincount(x[checkerboard].reshape(-1), minlength=256)
+
+def lsb_vr_capacity_sweep(im, alphas, max_ps, histogram=None):
+    # Available bits for every (alphas[i], max_ps[i]) pair from a single pass over the image
+    if histogram is None:
+        histogram = lsb_vr_xor_histogram(im)
+    return lsb_vr_bits_table(alphas, max_ps).astype(np.int64) @ histogram
+
+def lsb_vr_params_for_payload(im, payload_bits, alphas, max_ps):
+    # Pair with the smallest capacity still fitting the payload, so the fewest LSBits are changed
+    capacities = lsb_vr_capacity_sweep(im, alphas, max_ps)
+    fitting = np.flatnonzero(capacities >= payload_bits)
+    if len(fitting) == 0:
+        return None
+    best = fitting[np.argmin(capacities[fitting])]
+    return int(np.asarray(alphas)[best]), int(np.asarray(max_ps)[best])
+
+def plan_nbytes(plan):
+    return plan.bits_map.nbytes + plan.starts.nbytes
+
+def lsb_vr_plan(im, alpha=9, max_p=4):
+    # Memoized by image content, so repeated operations on the same image skip the capacity pass
+    key = (hashlib.blake2b(np.ascontiguousarray(im).data, digest_size=16).hexdigest(), im.shape, im.dtype.str, alpha, max_p)
+    if key in _plan_cache:
+        _plan_cache.move_to_end(key)
+        return _plan_cache[key]
+
+    bits_map = lsb_vr_bits_map(im, alpha, max_p)
+    starts, ends = bit_offsets(bits_map.reshape(-1))
+    bits_map.setflags(write=False)
+    starts.setflags(write=False)
+    plan = LsbVrPlan(int(ends[-1]) if len(ends) else 0, bits_map, starts)
+
+    if plan_nbytes(plan) > PLAN_CACHE_MAX_BYTES:
+        return plan
+    _plan_cache[key] = plan
+    while len(_plan_cache) > PLAN_CACHE_SIZE or sum(map(plan_nbytes, _plan_cache.values())) > PLAN_CACHE_MAX_BYTES:
+        _plan_cache.popitem(last=False)
+    return plan
+
+def lsb_vr_count_available_bits(im, alpha=9, max_p=4):
+    return lsb_vr_plan(im, alpha, max_p).total_bits
+
+def lsb_vr_bands(plan, bits_len, bands):
+    # Byte ranges of row bands which hold any secret bit, plan.starts gives the exact secret offset of each band
+    h1, w1, d1 = plan.bits_map.shape
+    used = used_bytes(plan.starts, bits_len)
+    edges = np.linspace(0, h1, bands + 1).astype(int) * w1 * d1
+    return [(int(lo), int(min(hi, used))) for lo, hi in zip(edges[:-1], edges[1:]) if lo < min(hi, used)]
+
+def lsb_vr_band_job(hide, handles, lo, hi):
+    shms, arrays = zip(*map(attach_array, handles))
+    values, p, starts, bits = arrays
+    if hide:
+        write_planes(values[lo:hi], p[lo:hi], starts[lo:hi], bits)
+    else:
+        read_planes(values[lo:hi], p[lo:hi], starts[lo:hi], bits)
+    del arrays, values, p, starts, bits # Views have to be dropped before the buffers are closed
+    for shm in shms:
+        release(shm)
+
+def lsb_vr_run_banded(hide, values, plan, bits, processes):
+    bands = lsb_vr_bands(plan, len(bits) - 8, processes * 4) # bits are zero padded by 8 entries
+    shms, views, handles = (list(t) for t in zip(*[share_array(arr) for arr in (values, plan.bits_map.reshape(-1), plan.starts, bits)]))
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for future in [executor.submit(lsb_vr_band_job, hide, handles, lo, hi) for lo, hi in bands]:
+                future.result()
+        return views[0 if hide else 3].copy()
+    finally:
+        views.clear() # Views have to be dropped before the buffers are closed
+        for shm in shms:
+            release(shm, unlink=True)
+
+def lsb_vr_hide(im1, im2, alpha=9, max_p=4, plan=None, processes=None):
+    if plan is None:
+        plan = lsb_vr_plan(im1, alpha, max_p)
+
+    im3 = im1.copy()
+    bits = np.unpackbits(np.ascontiguousarray(im2, dtype=np.uint8).reshape(-1)) # Secret pixels MSB first
+    if processes is None or processes < 2:
+        embed_bits(im3.reshape(-1), plan.bits_map.reshape(-1), bits, plan.starts)
+        return im3
+
+    return lsb_vr_run_banded(True, im3.reshape(-1), plan, pad_bits(bits), processes).reshape(im3.shape)
+
+def lsb_vr_reveal(im, hidden_shape, alpha=9, max_p=4, plan=None, processes=None):
     h2, w2, d2 = hidden_shape
-        
-    res = np.zeros(hidden_shape, dtype=np.uint8)
-    
-    im2_ctr = 0
-    res_b = 0
-    
-    for row in range(1, h1 - 1):
-        for col in range(1 + row%2, w1 - 1, 2):
-            for d in range(d1):
-                x = im[row - 1, col, d] ^ im[row + 1, col, d] ^ im[row, col - 1, d] ^ im[row, col + 1, d]
-                p = 1
-                if x > alpha:
-                    p = min(max_p, int(np.ceil(x/alpha)))
-                
-                b = im[row, col, d]
-                for j in range(p - 1, -1, -1):
-                    b2, z2, y2, x2 = coords_from_ctr(im2_ctr, h2, w2, d2)
-                    res_b = res_b | (((b>>j)&1) << (7 - b2)) # Take j-th LSB of b and insert it at b2-th MSG of res_b
-                    
-                    im2_ctr += 1
-                    if b2 == 7:
-                        res[x2, y2, z2] = res_b
-                        res_b = 0
-                    if im2_ctr == h2*w2*d2*8:
-                        return res
-                                    
-    return res
+    bits_len = h2*w2*d2*8
+    if plan is None:
+        plan = lsb_vr_plan(im, alpha, max_p)
+
+    values = np.ascontiguousarray(im).reshape(-1)
+    if processes is None or processes < 2:
+        bits = extract_bits(values, plan.bits_map.reshape(-1), bits_len, plan.starts)
+    else:
+        bits = lsb_vr_run_banded(False, values, plan, np.zeros(bits_len + 8, dtype=np.uint8), processes)
+        bits = trim_bits(bits, plan.total_bits, bits_len)
+    return bits_to_image(bits, hidden_shape)
+
+def lsb_vr_reveal_region(im, hidden_shape, rows=slice(None), cols=slice(None), alpha=9, max_p=4, plan=None):
+    # Reveals only hidden_image[rows, cols], plan.starts is used as the index from secret bits to cover bytes
+    if plan is None:
+        plan = lsb_vr_plan(im, alpha, max_p)
+
+    bit_indices = region_bit_indices(hidden_shape, rows, cols)
+    located = locate_bits(plan.bits_map.reshape(-1), plan.starts, bit_indices)
+    return read_located_bytes(np.ascontiguousarray(im).reshape(-1), located, bit_indices, plan.total_bits)
@@ -0,0 +1,195 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from alg_wrappers import lsb_basic_hide_wrapper, lsb_basic_reveal_wrapper, lsb_vr_hide_wrapper, lsb_vr_reveal_wrapper, coverless_hide_data_wrapper
+from algorithms.coverless import build_block_cache, publish_block_cache, get_message, BLOCKS_CACHE_DIR, BLOCKS_CACHE_MAX_BLOCKS
+from algorithms.shared_arrays import release
+from metrics import read_im
+
+
+ALGORITHMS = ["basic", "vr", "coverless"]
+OPERATIONS = ["hide", "reveal"]
+DEFAULT_PARAMS = {
+    "basic": {"color_proportion": [4, 4, 4]},
+    "vr": {"alpha": 9, "max_p": 4},
+    "coverless": {"eps": 0},
+}
+REPORT_COLUMNS = ["job", "algorithm", "operation", "image", "secret", "output", "status", "seconds", "error"]
+
+
+def write_im(path, im):
+    cv2.imwrite(path, cv2.cvtColor(im, cv2.COLOR_RGB2BGR))
+
+def params_tag(algorithm, params):
+    # Parameters in the form used by the names of the stored test images, e.g. paprica_boat_vr_94.tiff
+    if algorithm == "basic":
+        return "".join(str(c) for c in params["color_proportion"])
+    if algorithm == "vr":
+        return f"{params['alpha']}{params['max_p']}"
+    return f"eps{params['eps']}"
+
+def output_path(job, output_dir):
+    image = pathlib.Path(job["image"]).stem
+    if job["operation"] == "hide":
+        name = f"{image}_{pathlib.Path(job['secret']).stem}_{job['algorithm']}_{params_tag(job['algorithm'], job['params'])}.tiff"
+    else:
+        name = f"{image}_revealed" + (".txt" if job["algorithm"] == "coverless" else ".tiff")
+    return str(pathlib.Path(output_dir) / name)
+
+def new_job(algorithm, operation, image, secret=None, params=None, output=None):
+    if algorithm not in ALGORITHMS or operation not in OPERATIONS:
+        raise ValueError(f"Unknown job {algorithm} {operation}")
+    if operation == "hide" and secret is None:
+        raise ValueError(f"Hide job for {image} has no secret")
+    return {"algorithm": algorithm, "operation": operation, "image": image, "secret": secret,
+            "params": {**DEFAULT_PARAMS[algorithm], **(params or {})}, "output": output}
+
+
+def read_manifest(path):
+    # JSON lines, one job per line: {"algorithm", "operation", "image", "secret", "params", "output"},
+    # secret is only used by hide and output is optional. Relative paths are relative to the manifest
+    base = pathlib.Path(path).parent
+    resolve = lambda p: None if p is None else str(base / p)
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                jobs.append(new_job(entry["algorithm"], entry["operation"], resolve(entry["image"]), resolve(entry.get("secret")),
+                                    entry.get("params"), resolve(entry.get("output"))))
+    return jobs
+
+def glob_jobs(algorithm, operation, images_pattern, secrets_pattern=None, params=None):
+    # Images are paired with secrets in sorted order, a single secret is used for every image
+    images = sorted(glob.glob(images_pattern))
+    secrets = sorted(glob.glob(secrets_pattern)) if secrets_pattern else [None]
+    if len(secrets) == 1:
+        secrets = secrets * len(images)
+    if len(secrets) != len(images):
+        raise ValueError(f"{len(images)} images and {len(secrets)} secrets cannot be paired")
+    return [new_job(algorithm, operation, image, secret, params) for image, secret in zip(images, secrets)]
+
+
+def run_algorithm(algorithm, operation, image, secret=None, params=None, cache=None):
+    # Stego image of hide, secret image of LSB reveal and payload bytes of coverless reveal.
+    # secret is an RGB image, or the payload bytes for coverless
+    params = {**DEFAULT_PARAMS[algorithm], **(params or {})}
+    if operation == "hide":
+        if algorithm == "coverless":
+            return coverless_hide_data_wrapper(image, secret, cache, eps=params["eps"])
+        if algorithm == "basic":
+            return lsb_basic_hide_wrapper(image, secret, params["color_proportion"])
+        return lsb_vr_hide_wrapper(image, secret, params["alpha"], params["max_p"])
+    if algorithm == "coverless":
+        return get_message(image)
+    if algorithm == "basic":
+        return lsb_basic_reveal_wrapper(image, params["color_proportion"])
+    return lsb_vr_reveal_wrapper(image, params["alpha"], params["max_p"])
+
+def run_job(job, cache=None):
+    start = time.perf_counter()
+    try:
+        algorithm, operation = job["algorithm"], job["operation"]
+        secret = None
+        if operation == "hide" and algorithm == "coverless":
+            with open(job["secret"], "rb") as f:
+                secret = f.read()
+        elif operation == "hide":
+            secret = read_im(job["secret"])
+        result = run_algorithm(algorithm, operation, read_im(job["image"]), secret, job["params"], cache)
+        if isinstance(result, bytes):
+            with open(job["output"], "wb") as f:
+                f.write(result)
+        else:
+            write_im(job["output"], result)
+        status, error = "ok", ""
+    except Exception as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+    return {**job, "status": status, "seconds": time.perf_counter() - start, "error": error}
+
+def run_jobs_chunk(jobs, cache):
+    return [run_job(job, cache) for job in jobs]
+
+def run_jobs(jobs, processes=None, cache=None):
+    # Yields job results as they finish in submission order, jobs are sent to the pool in chunks
+    processes = processes or os.cpu_count() or 1
+    chunk_size = max(1, min(64, len(jobs) // (processes * 4)))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for results in executor.map(run_jobs_chunk, chunks, [cache] * len(chunks)):
+            yield from results
+
+def load_shared_cache(blocks_dir, processes):
+    # Block cache built from the files of blocks_dir (stored next to them) and published once for all workers
+    filenames = [str(f) for f in pathlib.Path(blocks_dir).iterdir() if f.is_file()]
+    cache = build_block_cache(filenames, None, str(pathlib.Path(blocks_dir) / BLOCKS_CACHE_DIR), processes, BLOCKS_CACHE_MAX_BLOCKS)
+    return publish_block_cache(cache)
+
+def write_report(path, results):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for i, result in enumerate(results):
+            writer.writerow({**result, "job": i, "seconds": f"{result['seconds']:.6f}", "secret": result["secret"] or ""})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hide and reveal for many images at once, without the GUI")
+    parser.add_argument("--manifest", help="JSON lines file with one job per line")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, help="algorithm of the jobs given by --images")
+    parser.add_argument("--operation", choices=OPERATIONS, default="hide")
+    parser.add_argument("--images", help="glob of the cover images (hide) or stego images (reveal)")
+    parser.add_argument("--secrets", help="glob of the secret images or coverless text files, paired with --images")
+    parser.add_argument("--color-proportion", type=int, nargs=3, help="basic LSB bits per R, G and B channel")
+    parser.add_argument("--alpha", type=int, help="VR LSB alpha")
+    parser.add_argument("--max-p", type=int, help="VR LSB maximum bits per channel")
+    parser.add_argument("--eps", type=float, help="coverless approximate block search")
+    parser.add_argument("--blocks-dir", help="directory of the images used as coverless block source")
+    parser.add_argument("--output", required=True, help="directory of the results and of report.csv")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.manifest:
+        jobs = read_manifest(args.manifest)
+    elif args.algorithm and args.images:
+        params = {k: v for k, v in (("color_proportion", args.color_proportion), ("alpha", args.alpha), ("max_p", args.max_p),
+                                    ("eps", args.eps)) if v is not None and k in DEFAULT_PARAMS[args.algorithm]}
+        jobs = glob_jobs(args.algorithm, args.operation, args.images, args.secrets, params)
+    else:
+        parser.error("either --manifest or --algorithm with --images is required")
+
+    os.makedirs(args.output, exist_ok=True)
+    for job in jobs:
+        job["output"] = job["output"] or output_path(job, args.output)
+        os.makedirs(pathlib.Path(job["output"]).parent, exist_ok=True)
+
+    shms, cache = [], None
+    if any(job["algorithm"] == "coverless" and job["operation"] == "hide" for job in jobs):
+        if not args.blocks_dir:
+            parser.error("coverless hide jobs require --blocks-dir")
+        shms, cache = load_shared_cache(args.blocks_dir, args.processes)
+
+    start = time.perf_counter()
+    results = []
+    try:
+        for result in run_jobs(jobs, args.processes, cache):
+            results.append(result)
+            if result["status"] != "ok":
+                print(f"{result['image']}: {result['error']}", file=sys.stderr)
+    finally:
+        for shm in shms:
+            release(shm, unlink=True)
+
+    write_report(os.path.join(args.output, "report.csv"), results)
+    failed = sum(result["status"] != "ok" for result in results)
+    print(f"{len(results) - failed}/{len(jobs)} jobs done in {time.perf_counter() - start:.2f} s, report in {os.path.join(args.output, 'report.csv')}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from algorithms.basic_lsb import lsb_basic_hide, lsb_basic_reveal
+from algorithms.variable_rate_lsb import lsb_vr_hide, lsb_vr_reveal, lsb_vr_plan
+from algorithms import variable_rate_lsb
+from algorithms.coverless import hide_data, get_message, build_block_cache, LENGTH_HEADER_BITS
+from alg_wrappers import lsb_vr_hidden_shape
+
+
+CORPORA = ["misc", "misc_gray", "misc_gray_128", "misc_gray_64"]
+ALGORITHMS = ["lsb_basic_hide", "lsb_basic_reveal", "lsb_vr_hide", "lsb_vr_reveal", "hide_data", "get_message", "build_block_cache"]
+BASIC_COLOR_PROPORTION = (2, 3, 4)
+VR_ALPHA, VR_MAX_P = 9, 4
+COVERLESS_PAYLOAD_BYTES = 1024 # Text sized payload, full capacity of a large cover takes minutes to hide
+REPEAT = 3
+THRESHOLD = 0.1 # Relative slowdown (or memory growth) reported as a regression
+RESULTS_DIR = "../benchmark_results"
+
+
+def read_corpus(corpus):
+    # Images of a corpus grouped by shape, every group is benchmarked as a separate size
+    groups = {}
+    for path in sorted(pathlib.Path("..", corpus).iterdir()):
+        im = cv2.imread(str(path))
+        if im is not None:
+            groups.setdefault(im.shape, []).append((str(path), im))
+    return groups
+
+def basic_hidden_shape(cover_shape):
+    bit_fraction_used = sum(BASIC_COLOR_PROPORTION)/24
+    return int(cover_shape[0] * np.sqrt(bit_fraction_used)), int(cover_shape[1] * np.sqrt(bit_fraction_used)), cover_shape[2]
+
+def secret_image(im, shape):
+    # Secret for a cover is the cover itself flipped and resized, so every cover of a corpus has its own secret
+    return cv2.resize(im[::-1, ::-1], (shape[1], shape[0]))
+
+def coverless_payload(shape, rng):
+    num_of_blocks = (shape[0] // 3) * (shape[1] // 3)
+    return rng.integers(0, 256, size=min(COVERLESS_PAYLOAD_BYTES, max(0, (num_of_blocks - LENGTH_HEADER_BITS) // 8)), dtype=np.uint8).tobytes()
+
+
+def prepare_case(algorithm, filenames, images):
+    # Callables timed for each image with the number of payload bits each of them moves.
+    # Work shared by a hide and the matching reveal (stego images, block cache) is done here, outside of the timing
+    rng = np.random.default_rng(0)
+    calls = []
+    if algorithm == "build_block_cache":
+        # Payload of the cache build is the channel of every image that is hashed into blocks
+        bits = sum(im.shape[0] * im.shape[1] * 8 for im in images)
+        return [(lambda: build_block_cache(filenames), bits)]
+
+    if algorithm in ("hide_data", "get_message"):
+        cache = build_block_cache(filenames)
+        for hash in (0, 1):
+            cache[hash].tree # KD-trees are built lazily, building them is part of build_block_cache benchmark
+        for im in images:
+            data = coverless_payload(im.shape, rng)
+            if algorithm == "hide_data":
+                calls.append((lambda im=im, data=data: hide_data(im.copy(), data, cache), len(data) * 8))
+            else:
+                stego = im.copy()
+                hide_data(stego, data, cache)
+                calls.append((lambda stego=stego: get_message(stego), len(data) * 8))
+        return calls
+
+    for im in images:
+        if algorithm.startswith("lsb_basic"):
+            hidden_shape = basic_hidden_shape(im.shape)
+            secret = secret_image(im, hidden_shape)
+            stego = lsb_basic_hide(im, secret, BASIC_COLOR_PROPORTION)
+            if algorithm == "lsb_basic_hide":
+                calls.append((lambda im=im, secret=secret: lsb_basic_hide(im, secret, BASIC_COLOR_PROPORTION), secret.size * 8))
+            else:
+                calls.append((lambda stego=stego, shape=hidden_shape: lsb_basic_reveal(stego, shape, BASIC_COLOR_PROPORTION), secret.size * 8))
+        else:
+            hidden_shape = lsb_vr_hidden_shape(im.shape, lsb_vr_plan(im, VR_ALPHA, VR_MAX_P).total_bits)
+            secret = secret_image(im, hidden_shape)
+            stego = lsb_vr_hide(im, secret, VR_ALPHA, VR_MAX_P)
+            if algorithm == "lsb_vr_hide":
+                calls.append((lambda im=im, secret=secret: lsb_vr_hide(im, secret, VR_ALPHA, VR_MAX_P), secret.size * 8))
+            else:
+                calls.append((lambda stego=stego, shape=hidden_shape: lsb_vr_reveal(stego, shape, VR_ALPHA, VR_MAX_P), secret.size * 8))
+    return calls
+
+def run_case(algorithm, corpus, shape, filenames, repeat):
+    # Runs in a fresh process, so the peak RSS belongs to this case only
+    images = [cv2.imread(f) for f in filenames]
+    calls = prepare_case(algorithm, filenames, images)
+
+    seconds = 0
+    for call, _ in calls:
+        best = float("inf")
+        for _ in range(repeat):
+            variable_rate_lsb._plan_cache.clear() # Capacity pass is part of every VR operation
+            start = time.perf_counter()
+            call()
+            best = min(best, time.perf_counter() - start)
+        seconds += best
+    payload_bits = sum(bits for _, bits in calls)
+
+    return {
+        "algorithm": algorithm,
+        "corpus": corpus,
+        "size": "x".join(map(str, shape)),
+        "images": len(images),
+        "seconds": seconds,
+        "payload_bits": payload_bits,
+        "bits_per_second": payload_bits / seconds if seconds > 0 else None,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # Kilobytes on Linux
+    }
+
+def run_benchmarks(algorithms, corpora, repeat=REPEAT):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for corpus in corpora:
+        for shape, files in read_corpus(corpus).items():
+            filenames = [f for f, _ in files]
+            for algorithm in algorithms:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_case, algorithm, corpus, shape, filenames, repeat).result()
+                print(f"{algorithm:>18} {corpus:>14} {result['size']:>12} {result['seconds']:10.4f} s "
+                      f"{(result['bits_per_second'] or 0) / 1e6:10.2f} Mbit/s {result['peak_rss_mb']:8.1f} MB")
+                results.append(result)
+    return results
+
+def environment():
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def result_key(result):
+    return result["algorithm"], result["corpus"], result["size"]
+
+def compare_results(baseline, current, threshold=THRESHOLD):
+    # Cases slower or using more memory than the baseline by more than threshold, as (key, metric, baseline, current)
+    baseline = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if result[metric] > old[metric] * (1 + threshold):
+                regressions.append((result_key(result), metric, old[metric], result[metric]))
+    return regressions
+
+def print_regressions(regressions, threshold):
+    if not regressions:
+        print(f"No regressions above {threshold:.0%}")
+        return
+    print(f"Regressions above {threshold:.0%}:")
+    for (algorithm, corpus, size), metric, old, new in regressions:
+        print(f"{algorithm:>18} {corpus:>14} {size:>12} {metric:>12}: {old:.4f} -> {new:.4f} ({new / old - 1:+.0%})")
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wall time, throughput and peak memory of the hide and reveal algorithms")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and save the results as JSON")
+    run_parser.add_argument("--algorithms", nargs="+", choices=ALGORITHMS, default=ALGORITHMS)
+    run_parser.add_argument("--corpora", nargs="+", choices=CORPORA, default=CORPORA)
+    run_parser.add_argument("--repeat", type=int, default=REPEAT, help="runs per image, the fastest one is kept")
+    run_parser.add_argument("--output", default=os.path.join(RESULTS_DIR, "latest.json"))
+    run_parser.add_argument("--baseline", help="results to compare with after the run")
+    run_parser.add_argument("--threshold", type=float, default=THRESHOLD)
+
+    compare_parser = subparsers.add_parser("compare", help="compare saved results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        current = {"environment": environment(), "results": run_benchmarks(args.algorithms, args.corpora, args.repeat)}
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+        baseline = load_results(args.baseline) if args.baseline else None
+    else:
+        current, baseline = load_results(args.current), load_results(args.baseline)
+
+    if baseline is not None:
+        regressions = compare_results(baseline, current, args.threshold)
+        print_regressions(regressions, args.threshold)
+        sys.exit(1 if regressions else 0)
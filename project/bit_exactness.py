@@ -0,0 +1,276 @@
+import argparse
+import fnmatch
+import pathlib
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from algorithms.basic_lsb import lsb_basic_hide, lsb_basic_reveal, lsb_basic_reveal_region
+from algorithms.variable_rate_lsb import lsb_vr_hide, lsb_vr_reveal, lsb_vr_reveal_region, lsb_vr_count_available_bits
+from alg_wrappers import lsb_basic_hide_wrapper, lsb_vr_hide_wrapper, lsb_vr_hidden_shape
+from metrics import read_im
+from metrics_tests import misc_mapping
+
+
+GOLDEN_DIRS = {"basic": "../basic_tests_images", "vr": "../vr_tests_images"}
+FUZZ_CASES = 200
+BANDED_EVERY = 20 # Every n-th VR fuzz case also runs the banded multiprocess path
+
+
+# Reference loops, the embedding every stored stego image was produced with. Fast engines have to match them bit for bit
+
+def reference_coords_from_ctr(ctr, h, w, d):
+    return ctr%8, ctr//8%d, ctr//(8*d)%w, ctr//(8*d*w)%h
+
+def reference_basic_hide(im1, im2, color_proportion=None):
+    h1, w1, d1 = im1.shape
+    h2, w2, d2 = im2.shape
+
+    if color_proportion is None:
+        color_proportion = [8*h2//h1]*3
+
+    im3 = im1.copy()
+    im2_ctr = 0
+
+    for x1 in range(h1):
+        for y1 in range(w1):
+            for z1 in range(d1):
+                b = im3[x1, y1, z1]
+                p = color_proportion[z1]
+                b = ((b>>p)<<p) # Wipe p LSBits from b
+                for j in range(p - 1, -1, -1):
+                    b2, z2, y2, x2 = reference_coords_from_ctr(im2_ctr, h2, w2, d2)
+                    b = b | (((im2[x2, y2, z2]>>(7 - b2))&1)<<j) # Take b2-th MSB of im2 pixel and insert it at j-th LSB of b
+                    im2_ctr += 1
+                    if im2_ctr == h2*w2*d2*8:
+                        im3[x1, y1, z1] = b
+                        return im3
+
+                im3[x1, y1, z1] = b
+    return im3
+
+def reference_basic_reveal(im, hidden_shape, color_proportion=None):
+    h1, w1, d1 = im.shape
+    h2, w2, d2 = hidden_shape
+
+    if color_proportion is None:
+        color_proportion = [8*h2//h1]*3
+
+    res = np.zeros(hidden_shape, dtype=np.uint8)
+    res_b = 0
+    im2_ctr = 0
+
+    for x1 in range(h1):
+        for y1 in range(w1):
+            for z1 in range(d1):
+                b = im[x1, y1, z1]
+                p = color_proportion[z1]
+                for j in range(p - 1, -1, -1):
+                    b2, z2, y2, x2 = reference_coords_from_ctr(im2_ctr, h2, w2, d2)
+                    res_b = res_b | (((b>>j)&1) << (7 - b2)) # Take j-th LSB of b and insert it at b2-th MSG of res_b
+
+                    im2_ctr += 1
+                    if b2 == 7:
+                        res[x2, y2, z2] = res_b
+                        res_b = 0
+                    if im2_ctr == h2*w2*d2*8:
+                        return res
+
+    return res
+
+def reference_vr_count_available_bits(im, alpha=9, max_p=4):
+    h1, w1, d1 = im.shape
+
+    result = 0
+
+    for row in range(1, h1 - 1):
+        for col in range(1 + row%2, w1 - 1, 2):
+            for d in range(d1):
+                x = im[row - 1, col, d] ^ im[row + 1, col, d] ^ im[row, col - 1, d] ^ im[row, col + 1, d]
+                result += min(max_p, int(np.ceil(x/alpha))) if x > alpha else 1
+
+    return result
+
+def reference_vr_hide(im1, im2, alpha=9, max_p=4):
+    h1, w1, d1 = im1.shape
+    h2, w2, d2 = im2.shape
+
+    im3 = im1.copy()
+
+    im2_ctr = 0
+
+    for row in range(1, h1 - 1):
+        for col in range(1 + row%2, w1 - 1, 2):
+            for d in range(d1):
+                x = im1[row - 1, col, d] ^ im1[row + 1, col, d] ^ im1[row, col - 1, d] ^ im1[row, col + 1, d]
+                p = 1
+                if x > alpha:
+                    p = min(max_p, int(np.ceil(x/alpha)))
+
+                b = im3[row, col, d]
+                b = ((b>>p)<<p) # Wipe p LSBits from b
+                for j in range(p - 1, -1, -1):
+                    b2, z2, y2, x2 = reference_coords_from_ctr(im2_ctr, h2, w2, d2)
+                    b = b | (((im2[x2, y2, z2]>>(7 - b2))&1)<<j) # Take b2-th MSB of im2 pixel and insert it at j-th LSB of b
+                    im2_ctr += 1
+                    if im2_ctr == h2*w2*d2*8:
+                        im3[row, col, d] = b
+                        return im3
+                im3[row, col, d] = b
+    return im3
+
+def reference_vr_reveal(im, hidden_shape, alpha=9, max_p=4):
+    h1, w1, d1 = im.shape
+    h2, w2, d2 = hidden_shape
+
+    res = np.zeros(hidden_shape, dtype=np.uint8)
+
+    im2_ctr = 0
+    res_b = 0
+
+    for row in range(1, h1 - 1):
+        for col in range(1 + row%2, w1 - 1, 2):
+            for d in range(d1):
+                x = im[row - 1, col, d] ^ im[row + 1, col, d] ^ im[row, col - 1, d] ^ im[row, col + 1, d]
+                p = 1
+                if x > alpha:
+                    p = min(max_p, int(np.ceil(x/alpha)))
+
+                b = im[row, col, d]
+                for j in range(p - 1, -1, -1):
+                    b2, z2, y2, x2 = reference_coords_from_ctr(im2_ctr, h2, w2, d2)
+                    res_b = res_b | (((b>>j)&1) << (7 - b2)) # Take j-th LSB of b and insert it at b2-th MSG of res_b
+
+                    im2_ctr += 1
+                    if b2 == 7:
+                        res[x2, y2, z2] = res_b
+                        res_b = 0
+                    if im2_ctr == h2*w2*d2*8:
+                        return res
+
+    return res
+
+
+def mismatch(name, expected, actual):
+    # Description of the difference, None when both arrays are identical
+    expected, actual = np.asarray(expected), np.asarray(actual)
+    if expected.shape != actual.shape or expected.dtype != actual.dtype:
+        return f"{name}: {actual.dtype}{actual.shape} instead of {expected.dtype}{expected.shape}"
+    differing = int(np.count_nonzero(expected != actual))
+    return f"{name}: {differing} of {expected.size} values differ" if differing else None
+
+def random_region(rng, hidden_shape):
+    # Random rows and cols selection, a strided slice or a sorted index array
+    def pick(n):
+        if rng.random() < 0.5:
+            start = int(rng.integers(0, n))
+            return slice(start, int(rng.integers(start + 1, n + 1)), int(rng.integers(1, 4)))
+        return np.sort(rng.choice(n, size=int(rng.integers(1, n + 1)), replace=False))
+    return pick(hidden_shape[0]), pick(hidden_shape[1])
+
+def region_mismatch(name, revealed, reveal_region, rng, hidden_shape):
+    rows, cols = random_region(rng, hidden_shape)
+    return mismatch(name, revealed[rows][:, cols], reveal_region(rows, cols))
+
+
+def golden_basic_hidden_shape(cover_shape, color_proportion):
+    bit_fraction_used = sum(color_proportion)/24
+    return int(cover_shape[0] * np.sqrt(bit_fraction_used)), int(cover_shape[1] * np.sqrt(bit_fraction_used)), cover_shape[2]
+
+def check_golden_file(path):
+    # Hide of the fast engine has to reproduce the stored stego image, fast reveals have to match the reference reveal
+    name = pathlib.Path(path).name
+    cover_name, hidden_name, kind, params = re.search(r"(.*)_(.*)_(basic|vr)_(.*).tiff", name).groups()
+    cover, secret, stego = read_im(misc_mapping[cover_name]), read_im(misc_mapping[hidden_name]), read_im(path)
+    rng = np.random.default_rng(list(name.encode()))
+
+    if kind == "basic":
+        color_proportion = [int(c) for c in params]
+        hidden_shape = golden_basic_hidden_shape(cover.shape, color_proportion)
+        revealed = lsb_basic_reveal(stego, hidden_shape, color_proportion)
+        problems = [
+            mismatch("hide", stego, lsb_basic_hide_wrapper(cover, secret, color_proportion)),
+            mismatch("reveal", reference_basic_reveal(stego, hidden_shape, color_proportion), revealed),
+            region_mismatch("reveal_region", revealed, lambda rows, cols: lsb_basic_reveal_region(stego, hidden_shape, rows, cols, color_proportion), rng, hidden_shape),
+        ]
+    else:
+        alpha, max_p = int(params[:-1]), int(params[-1])
+        capacity = reference_vr_count_available_bits(cover, alpha, max_p)
+        hidden_shape = lsb_vr_hidden_shape(cover.shape, capacity)
+        revealed = lsb_vr_reveal(stego, hidden_shape, alpha, max_p)
+        problems = [
+            None if capacity == lsb_vr_count_available_bits(cover, alpha, max_p) else f"capacity: {lsb_vr_count_available_bits(cover, alpha, max_p)} instead of {capacity}",
+            mismatch("hide", stego, lsb_vr_hide_wrapper(cover, secret, alpha, max_p)),
+            mismatch("reveal", reference_vr_reveal(stego, hidden_shape, alpha, max_p), revealed),
+            region_mismatch("reveal_region", revealed, lambda rows, cols: lsb_vr_reveal_region(stego, hidden_shape, rows, cols, alpha, max_p), rng, hidden_shape),
+        ]
+    return name, [p for p in problems if p is not None]
+
+def golden_files(pattern="*"):
+    return [str(f) for kind in GOLDEN_DIRS for f in sorted(pathlib.Path(GOLDEN_DIRS[kind]).iterdir()) if fnmatch.fnmatch(f.name, pattern)]
+
+
+def fuzz_case(seed):
+    # One random basic LSB and one random VR LSB round trip checked against the reference loops
+    rng = np.random.default_rng(seed)
+    d = int(rng.choice([1, 3]))
+    h1, w1 = (int(v) for v in rng.integers(1, 40, 2))
+    h2, w2 = (int(v) for v in rng.integers(1, 24, 2))
+    cover = rng.integers(0, 256, (h1, w1, d), dtype=np.uint8)
+    secret = rng.integers(0, 256, (h2, w2, d), dtype=np.uint8)
+    problems = []
+
+    color_proportion = [int(c) for c in rng.integers(0, 9, 3)]
+    if sum(color_proportion[:d]) == 0:
+        color_proportion[0] = 1
+    stego = lsb_basic_hide(cover, secret, color_proportion)
+    revealed = lsb_basic_reveal(stego, secret.shape, color_proportion)
+    problems += [
+        mismatch(f"basic hide {color_proportion}", reference_basic_hide(cover, secret, color_proportion), stego),
+        mismatch(f"basic reveal {color_proportion}", reference_basic_reveal(stego, secret.shape, color_proportion), revealed),
+        region_mismatch(f"basic reveal_region {color_proportion}", revealed, lambda rows, cols: lsb_basic_reveal_region(stego, secret.shape, rows, cols, color_proportion), rng, secret.shape),
+    ]
+
+    cover = cover if h1 >= 3 and w1 >= 3 else rng.integers(0, 256, (h1 + 3, w1 + 3, d), dtype=np.uint8)
+    alpha, max_p = int(rng.integers(1, 64)), int(rng.integers(1, 9))
+    processes = 2 if seed % BANDED_EVERY == 0 else None
+    stego = lsb_vr_hide(cover, secret, alpha, max_p, processes=processes)
+    revealed = lsb_vr_reveal(stego, secret.shape, alpha, max_p, processes=processes)
+    capacity = reference_vr_count_available_bits(cover, alpha, max_p)
+    problems += [
+        None if capacity == lsb_vr_count_available_bits(cover, alpha, max_p) else f"vr capacity ({alpha}, {max_p}): {lsb_vr_count_available_bits(cover, alpha, max_p)} instead of {capacity}",
+        mismatch(f"vr hide ({alpha}, {max_p})", reference_vr_hide(cover, secret, alpha, max_p), stego),
+        mismatch(f"vr reveal ({alpha}, {max_p})", reference_vr_reveal(stego, secret.shape, alpha, max_p), revealed),
+        region_mismatch(f"vr reveal_region ({alpha}, {max_p})", revealed, lambda rows, cols: lsb_vr_reveal_region(stego, secret.shape, rows, cols, alpha, max_p), rng, secret.shape),
+    ]
+    return f"fuzz {seed} {cover.shape} -> {secret.shape}", [p for p in problems if p is not None]
+
+
+def run_checks(check, jobs, processes=None):
+    # Prints every failing job, returns the number of failures
+    failures = 0
+    with ProcessPoolExecutor(processes) as executor:
+        for name, problems in executor.map(check, jobs):
+            if problems:
+                failures += 1
+                print(f"FAIL {name}: " + "; ".join(problems))
+    print(f"{len(jobs) - failures}/{len(jobs)} passed")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bit exactness of the LSB engines against the reference loops and the stored stego images")
+    parser.add_argument("--pattern", default="*", help="glob of the stored stego files to check")
+    parser.add_argument("--fuzz", type=int, default=FUZZ_CASES, help="number of random cases")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first random case")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    files = golden_files(args.pattern)
+    print(f"Stored stego images ({len(files)}):")
+    failures = run_checks(check_golden_file, files, args.processes)
+    print(f"Random cases ({args.fuzz}):")
+    failures += run_checks(fuzz_case, list(range(args.seed, args.seed + args.fuzz)), args.processes)
+    sys.exit(1 if failures else 0)
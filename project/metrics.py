@@ -1,5 +1,4 @@
-from skimage.metrics import peak_signal_noise_ratio, mean_squared_error, structural_similarity
-from sklearn.metrics import mean_absolute_error
+from skimage.metrics import structural_similarity
 import sys
 import cv2
 import numpy as np 
@@ -7,21 +6,49 @@ import numpy as np
 def read_im(path):
     return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
 
-def ncc(cover_im, stego_im):
-    return np.sum(cover_im * stego_im) / np.sum(np.square(stego_im))
+def image_metrics(cover_im, stego_im, ssim=True):
+    # PSNR, MSE, RMSE, MAE, SSIM and NCC from a single int32 difference, images may be batched as (N, H, W, C),
+    # a single cover is compared with every stego image of a batch. SSIM is None when not requested
+    diff = np.subtract(stego_im, cover_im, dtype=np.int32)
+    stego_im = np.broadcast_to(stego_im, diff.shape)
+    axes = (-3, -2, -1)
+    size = np.prod(diff.shape[-3:])
+
+    squared_sum = np.einsum('...ijk,...ijk->...', diff, diff, dtype=np.int64)
+    stego_squared_sum = np.einsum('...ijk,...ijk->...', stego_im, stego_im, dtype=np.int64)
+    stego_diff_sum = np.einsum('...ijk,...ijk->...', stego_im, diff, dtype=np.int64)
+    abs_sum = np.abs(diff, out=diff).sum(axis=axes, dtype=np.int64)
+
+    mse = squared_sum / size
+    with np.errstate(divide='ignore'):
+        psnr = 10 * np.log10(255 ** 2 / mse)
+    rmse = np.sqrt(mse)
+    mae = abs_sum / size
+    ncc = 1 - stego_diff_sum / stego_squared_sum # sum(cover * stego) / sum(stego^2), as cover = stego - diff
+
+    ssim_value = None
+    if ssim:
+        covers = np.broadcast_to(cover_im, diff.shape).reshape((-1,) + diff.shape[-3:])
+        stegos = stego_im.reshape((-1,) + diff.shape[-3:])
+        ssim_value = np.array([structural_similarity(c, s, channel_axis=2) for c, s in zip(covers, stegos)]).reshape(diff.shape[:-3])
+
+    return tuple(v if v is None or np.ndim(v) else float(v) for v in (psnr, mse, rmse, mae, ssim_value, ncc))
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python metrics.py <cover_image> <stego_image>")
+        print("Usage: python metrics.py <cover_image> <stego_image> [<stego_image> ...]")
         sys.exit(1)
     
     cover_im = read_im(sys.argv[1])
-    stego_im = read_im(sys.argv[2])
-
-    print(f"Image quality metrics for {sys.argv[1]} and {sys.argv[2]}:")
-    print("PSNR:", peak_signal_noise_ratio(cover_im, stego_im))
-    print("MSE: ", mean_squared_error(cover_im, stego_im))
-    print("RMSE:", np.sqrt(mean_squared_error(cover_im, stego_im)))
-    print("MAE: ", mean_absolute_error(cover_im.flatten(), stego_im.flatten()))
-    print("SSIM:", structural_similarity(cover_im, stego_im, channel_axis=2))
-    print("NCC: ", ncc(cover_im, stego_im))
+    stego_ims = np.stack([read_im(path) for path in sys.argv[2:]])
+    results = image_metrics(cover_im, stego_ims)
+
+    for i, stego_path in enumerate(sys.argv[2:]):
+        psnr, mse, rmse, mae, ssim, ncc = (v[i] for v in results)
+        print(f"Image quality metrics for {sys.argv[1]} and {stego_path}:")
+        print("PSNR:", psnr)
+        print("MSE: ", mse)
+        print("RMSE:", rmse)
+        print("MAE: ", mae)
+        print("SSIM:", ssim)
+        print("NCC: ", ncc)
@@ -1,12 +1,13 @@
-from skimage.metrics import peak_signal_noise_ratio, mean_squared_error, structural_similarity
-from sklearn.metrics import mean_absolute_error
-import cv2
-import numpy as np 
 import pathlib
 import re
 import pandas as pd
 import math
-from algorithms.variable_rate_lsb import lsb_vr_count_available_bits
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from algorithms.variable_rate_lsb import lsb_vr_capacity_sweep
+from metrics import image_metrics, read_im
 
 
 misc_mapping = {
@@ -27,78 +28,103 @@ misc_shapes = {
     "splash": (512, 512),
 }
 
-def read_im(path):
-    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+basic_params = ["111", "222", "234", "333", "432", "246", "444", "666"]
+vr_params = ["202", "22", "204", "104", "94", "44", "24", "206", "106", "26"]
+metrics_columns = ['PSNR', 'MSE', 'RMSE', 'MAE', 'SSIM', 'NCC']
+results_dir = "../metrics_results"
 
-def NCC(cover_im, stego_im):
-    return np.sum(cover_im * stego_im) / np.sum(np.square(stego_im))
+_vr_capacities = {} # (cover_name, alpha, max_p) -> number of available bits
 
-def get_metrics(cover_name, stego_name):
-    cover_im = read_im(cover_name)
-    stego_im = read_im(stego_name)
+@lru_cache(maxsize=None)
+def read_cover(cover_name):
+    # Every cover is decoded once per process
+    return read_im(misc_mapping[cover_name])
 
-    psnr = peak_signal_noise_ratio(cover_im, stego_im)
-    mse = mean_squared_error(cover_im, stego_im)
-    rmse = np.sqrt(mean_squared_error(cover_im, stego_im))
-    mae = mean_absolute_error(cover_im.flatten(), stego_im.flatten())
-    ssim = structural_similarity(cover_im, stego_im, channel_axis=2)
-    ncc = NCC(cover_im, stego_im)
+def get_metrics(cover_name, stego_name):
+    return image_metrics(read_im(cover_name), read_im(stego_name))
 
-    return psnr, mse, rmse, mae, ssim, ncc
+def score_stego_file(job):
+    cover_name, stego_name = job
+    return image_metrics(read_cover(cover_name), read_im(stego_name))
 
 def basic_lsb_result_ratio(cover_shape, hidden_shape, color_proportion):
     bit_fraction_used = sum(color_proportion)/24
     return int(cover_shape[0] * math.sqrt(bit_fraction_used)) / hidden_shape[0]
 
-def vr_lsb_result_ratio(cover_name, hidden_shape, alpha, max_p):
-    cover_im = read_im(cover_name)
-    cover_shape = cover_im.shape
-    bit_fraction_used = lsb_vr_count_available_bits(cover_im, alpha, max_p) / (cover_shape[0] * cover_shape[1] * cover_shape[2] * 8)
-    return int(cover_shape[0] * math.sqrt(bit_fraction_used)) / hidden_shape[0]
+def vr_lsb_capacities(cover_name, params):
+    # Capacities missing from the memo are computed in one sweep over the cover
+    missing = [p for p in params if (cover_name,) + p not in _vr_capacities]
+    if missing:
+        alphas, max_ps = [p[0] for p in missing], [p[1] for p in missing]
+        for p, available_bits in zip(missing, lsb_vr_capacity_sweep(read_cover(cover_name), alphas, max_ps)):
+            _vr_capacities[(cover_name,) + p] = available_bits
+    return [_vr_capacities[(cover_name,) + p] for p in params]
+
+def vr_lsb_result_ratios(cover_name, hidden_shape, vr_params):
+    cover_shape = read_cover(cover_name).shape
+    params = [(int(p[:-1]), int(p[-1])) for p in vr_params]
+    ratios = {}
+    for p, available_bits in zip(vr_params, vr_lsb_capacities(cover_name, params)):
+        bit_fraction_used = available_bits / (cover_shape[0] * cover_shape[1] * cover_shape[2] * 8)
+        ratios[p] = int(cover_shape[0] * math.sqrt(bit_fraction_used)) / hidden_shape[0]
+    return ratios
+
+def score_stego_files(path, kind, result_ratio, processes=None):
+    # One row per stego file in path, the files are scored on a process pool
+    files = sorted(pathlib.Path(path).iterdir())
+    names = [re.search(rf"(.*)_(.*)_{kind}_(.*).tiff", f.name).groups() for f in files]
+    jobs = [(cover_name, str(f)) for f, (cover_name, _, _) in zip(files, names)]
+    with ProcessPoolExecutor(processes) as executor:
+        metrics = list(executor.map(score_stego_file, jobs, chunksize=max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1)))))
+
+    rows = [(cover_name, hidden_name, params, result_ratio(cover_name, hidden_name, params)) + m
+            for (cover_name, hidden_name, params), m in zip(names, metrics)]
+    return pd.DataFrame(rows, columns=['cover', 'hidden', 'params', 'ratio'] + metrics_columns)
 
-def basic_lsb_metrics():
-    basic_params = ["111", "222", "234", "333", "432", "246", "444", "666"]
+def basic_lsb_ratio(cover_name, hidden_name, params):
+    params_tuple = int(params[0]), int(params[1]), int(params[2])
+    return basic_lsb_result_ratio(misc_shapes[cover_name], misc_shapes[hidden_name], params_tuple)
+
+def vr_lsb_ratio(cover_name, hidden_name, params):
+    return vr_lsb_result_ratios(cover_name, misc_shapes[hidden_name], vr_params)[params]
+
+def print_results(df, params, index, index_name):
+    for cover_name, cover_df in df.groupby('cover', sort=False):
+        print(f"{cover_name}:")
+        table = cover_df.set_index('params')[['ratio'] + metrics_columns].reindex(params)
+        table.index = index
+        table.index.name = index_name
+        print(table, end="\n\n")
+
+def write_results(df, name):
+    os.makedirs(results_dir, exist_ok=True)
+    base = os.path.join(results_dir, name)
+    df.to_csv(base + ".csv", index=False)
+    try:
+        df.to_parquet(base + ".parquet", index=False)
+    except ImportError:
+        pass # Neither pyarrow nor fastparquet is installed
+
+def basic_lsb_metrics(processes=None):
     basic_path = "../basic_tests_images"
-    files_metrics = {}
-   
+
     print("Basic LSB:") 
-    for filename in pathlib.Path(basic_path).iterdir():
-        cover_name, hidden_name, params = re.search(r"(.*)_(.*)_basic_(.*).tiff", filename.name).groups()
-        metrics = get_metrics(misc_mapping[cover_name], str(filename))
-        if cover_name not in files_metrics:
-            files_metrics[cover_name] = [None]*len(basic_params)
-        params_tuple = int(params[0]), int(params[1]), int(params[2])
-        ratio = basic_lsb_result_ratio(misc_shapes[cover_name], misc_shapes[hidden_name], params_tuple)
-        files_metrics[cover_name][basic_params.index(params)] = (ratio,) + metrics
-    
-    for file, metrics in files_metrics.items():
-        print(f"{file}:")
-        df = pd.DataFrame(metrics, columns=['ratio', 'PSNR', 'MSE', 'RMSE', 'MAE', 'SSIM', 'NCC'], index=basic_params)
-        df.index.name = 'RGB'
-        print(df, end="\n\n")
-
-def vr_lsb_metrics():
-    vr_params = ["202", "22", "204", "104", "94", "44", "24", "206", "106", "26"]
+    df = score_stego_files(basic_path, "basic", basic_lsb_ratio, processes)
+    print_results(df, basic_params, basic_params, 'RGB')
+    write_results(df, "basic_lsb")
+    return df
+
+def vr_lsb_metrics(processes=None):
     vr_path = "../vr_tests_images"
-    files_metrics = {}
 
     print("VR LSB:")
-    for filename in pathlib.Path(vr_path).iterdir():
-        cover_name, hidden_name, params = re.search(r"(.*)_(.*)_vr_(.*).tiff", filename.name).groups()
-        metrics = get_metrics(misc_mapping[cover_name], str(filename))
-        if cover_name not in files_metrics:
-            files_metrics[cover_name] = [None]*len(vr_params)
-        alpha, max_p = int(params[:-1]), int(params[-1])
-        ratio = vr_lsb_result_ratio(misc_mapping[cover_name], misc_shapes[hidden_name], alpha, max_p)
-        files_metrics[cover_name][vr_params.index(params)] = (ratio,) + metrics
-    
-    for file, metrics in files_metrics.items():
-        print(f"{file}:")
-        df = pd.DataFrame(metrics, columns=['ratio', 'PSNR', 'MSE', 'RMSE', 'MAE', 'SSIM', 'NCC'], index=[f"{p[:-1]: >2}, {p[-1]: >2}" for p in vr_params])
-        df.index.name = ' a, mb'
-        print(df, end="\n\n")
+    df = score_stego_files(vr_path, "vr", vr_lsb_ratio, processes)
+    print_results(df, vr_params, [f"{p[:-1]: >2}, {p[-1]: >2}" for p in vr_params], ' a, mb')
+    write_results(df, "vr_lsb")
+    return df
 
 
 if __name__ == "__main__":
-    basic_lsb_metrics()
-    vr_lsb_metrics()
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    basic_lsb_metrics(processes)
+    vr_lsb_metrics(processes)
@@ -0,0 +1,291 @@
+import argparse
+import base64
+import json
+import os
+import pathlib
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from algorithms.coverless import build_block_cache, publish_block_cache, get_block_cache, BLOCKS_CACHE_DIR, \
+    BLOCKS_CACHE_MAX_BLOCKS
+from algorithms.shared_arrays import release
+from batch import ALGORITHMS, OPERATIONS, run_algorithm
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+QUEUE_LIMIT_PER_PROCESS = 4 # Requests admitted per worker, running ones included, the rest gets 503
+REQUEST_TIMEOUT = 300 # Seconds a request waits for its result
+MAX_BODY_BYTES = 256 * 1024 * 1024
+LATENCY_WINDOW = 1000 # Latencies kept per route for the percentiles
+
+
+def decode_im(data):
+    im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if im is None:
+        raise ValueError("Image payload cannot be decoded")
+    return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+
+def encode_im(im):
+    # PNG keeps the stego bits intact, unlike any lossy format
+    _, data = cv2.imencode(".png", cv2.cvtColor(im, cv2.COLOR_RGB2BGR))
+    return data.tobytes()
+
+def warm_worker(shared_caches):
+    # Attaches every resident block cache and builds its search trees before the first request arrives
+    for shared_cache in shared_caches:
+        cache = get_block_cache(shared_cache)
+        for hash in (0, 1):
+            if len(cache[hash]):
+                cache[hash].tree
+    run_algorithm("vr", "reveal", np.zeros((8, 8, 3), dtype=np.uint8))
+
+def service_job(algorithm, operation, image, secret, params, cache):
+    # Runs in a worker, images come and go encoded so the HTTP threads only move bytes
+    image = decode_im(image)
+    if operation == "hide" and algorithm != "coverless":
+        secret = decode_im(secret)
+    result = run_algorithm(algorithm, operation, image, secret, params, cache)
+    return ("data", result) if isinstance(result, bytes) else ("image", encode_im(result))
+
+
+class RouteStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def snapshot(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "latency_max": float(latencies.max()),
+        }
+
+
+class EmbeddingService:
+    # Warm worker pool with resident block caches, requests over the limit are rejected instead of queued without bound
+    def __init__(self, processes=None, queue_limit=None, blocks_dirs=()):
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_limit = queue_limit or self.processes * QUEUE_LIMIT_PER_PROCESS
+        self.slots = threading.BoundedSemaphore(self.queue_limit)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.routes = {}
+        self.started = time.time()
+
+        self.shms, self.caches = [], {}
+        for blocks_dir in blocks_dirs:
+            filenames = [str(f) for f in pathlib.Path(blocks_dir).iterdir() if f.is_file()]
+            cache = build_block_cache(filenames, None, str(pathlib.Path(blocks_dir) / BLOCKS_CACHE_DIR), self.processes, BLOCKS_CACHE_MAX_BLOCKS)
+            shms, self.caches[pathlib.Path(blocks_dir).name] = publish_block_cache(cache)
+            self.shms += shms
+
+        self.shared_caches = tuple(self.caches.values())
+        self.restarts = 0
+        self.executor = self.start_pool()
+        # Workers are started by the first tasks, every one of them is warmed by the initializer
+        for future in [self.executor.submit(warm_worker, ()) for _ in range(self.processes)]:
+            future.result()
+
+    def start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.processes, initializer=warm_worker, initargs=(self.shared_caches,))
+
+    def pool_broken(self):
+        # Set by the executor as soon as one of its workers dies, idle or not
+        return bool(getattr(self.executor, "_broken", False))
+
+    def restart_pool(self, executor):
+        # A dead worker breaks the whole pool, its futures fail and it takes no new tasks, so it is replaced.
+        # Only the executor seen broken is replaced, threads which saw the same failure do not restart the new one
+        with self.lock:
+            if self.executor is not executor:
+                return
+            self.executor = self.start_pool()
+            self.restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, algorithm, operation, image, secret, params, cache_name):
+        # None when the queue is full, BrokenProcessPool when the pool died and is being replaced
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return None
+        cache = None
+        if algorithm == "coverless" and operation == "hide":
+            cache = self.caches.get(cache_name) if cache_name else next(iter(self.caches.values()), None)
+            if cache is None:
+                self.slots.release()
+                raise ValueError(f"Block cache {cache_name} is not loaded" if cache_name else "No block cache is loaded")
+        with self.lock:
+            self.pending += 1
+            executor = self.executor
+        try:
+            future = executor.submit(service_job, algorithm, operation, image, secret, params, cache)
+        except BaseException as e:
+            self.finished(None)
+            if isinstance(e, BrokenProcessPool):
+                self.restart_pool(executor)
+            raise
+        future.executor = executor
+        future.add_done_callback(self.finished)
+        return future
+
+    def result(self, future):
+        try:
+            return future.result(timeout=REQUEST_TIMEOUT)
+        except BrokenProcessPool:
+            self.restart_pool(future.executor)
+            raise
+
+    def finished(self, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def record(self, route, seconds, error):
+        with self.lock:
+            stats = self.routes.setdefault(route, RouteStats())
+            stats.count += 1
+            stats.errors += error
+            stats.latencies.append(seconds)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "processes": self.processes,
+                "queue_depth": self.pending,
+                "queue_limit": self.queue_limit,
+                "rejected": self.rejected,
+                "pool_restarts": self.restarts,
+                "block_caches": list(self.caches),
+                "routes": {route: stats.snapshot() for route, stats in self.routes.items()},
+            }
+
+    def health(self):
+        # A broken pool is replaced here too, so a worker killed while the service is idle does not wait for a request
+        executor = self.executor
+        if self.pool_broken():
+            self.restart_pool(executor)
+            return {"status": "restarting", "restarts": self.restarts}
+        return {"status": "ok", "restarts": self.restarts}
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        for shm in self.shms:
+            release(shm, unlink=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # POST /hide/<algorithm> and /reveal/<algorithm> take and return JSON with base64 payloads:
+    # {"image": ..., "secret": ..., "params": {...}, "cache": name} -> {"image": PNG} or {"data": bytes}
+    # GET /metrics returns queue depth and latencies, GET /health is a liveness check
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.server.service.metrics())
+        elif self.path == "/health":
+            health = self.server.service.health()
+            self.send_json(200 if health["status"] == "ok" else 503, health)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        status = self.handle_job()
+        route = self.path if status != 404 else "unknown"
+        self.server.service.record(route, time.perf_counter() - start, status >= 400)
+
+    def handle_job(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] not in OPERATIONS or parts[1] not in ALGORITHMS:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return 404
+        operation, algorithm = parts
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY_BYTES:
+            self.send_json(413, {"error": f"Request body larger than {MAX_BODY_BYTES} bytes"})
+            return 413
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.read(length))
+            image = base64.b64decode(request["image"])
+            secret = base64.b64decode(request["secret"]) if operation == "hide" else None
+            future = service.submit(algorithm, operation, image, secret, request.get("params"), request.get("cache"))
+        except BrokenProcessPool:
+            self.send_json(503, {"error": "Worker pool is restarting"}, [("Retry-After", "1")])
+            return 503
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return 400
+        if future is None:
+            self.send_json(503, {"error": "Queue is full"}, [("Retry-After", "1")])
+            return 503
+
+        try:
+            kind, result = service.result(future)
+        except TimeoutError:
+            self.send_json(504, {"error": f"No result in {REQUEST_TIMEOUT} s"})
+            return 504
+        except BrokenProcessPool:
+            # The job may be what killed its worker, so it is not retried
+            self.send_json(500, {"error": "Worker died while running the job"})
+            return 500
+        except Exception as e:
+            self.send_json(422, {"error": f"{type(e).__name__}: {e}"})
+            return 422
+        self.send_json(200, {kind: base64.b64encode(result).decode()})
+        return 200
+
+
+def serve(host=HOST, port=PORT, processes=None, queue_limit=None, blocks_dirs=()):
+    service = EmbeddingService(processes, queue_limit, blocks_dirs)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # Shared memory is released in finally on termination too
+    print(f"Serving on http://{host}:{port} with {service.processes} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hide and reveal over HTTP on localhost with a warm worker pool")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--queue-limit", type=int, default=None, help="requests admitted at once, running ones included")
+    parser.add_argument("--blocks-dir", action="append", default=[], help="coverless block source, kept resident, may be repeated")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.processes, args.queue_limit, args.blocks_dir)
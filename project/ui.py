@@ -1,12 +1,15 @@
-from nicegui import app, ui, run
+from nicegui import app, ui, run, Client
+import base64
 import cv2
+import hashlib
+import os
 import pathlib
-import shutil
-import random
-from multiprocessing import Manager
+from collections import OrderedDict
 
 from alg_wrappers import lsb_basic_hide_wrapper, lsb_basic_reveal_wrapper, lsb_vr_hide_wrapper, lsb_vr_reveal_wrapper, coverless_hide_data_wrapper
-from algorithms.coverless import build_block_cache, get_message
+from algorithms.coverless import build_block_cache, publish_block_cache, get_message, BLOCKS_CACHE_DIR, BLOCKS_CACHE_MAX_BLOCKS
+from algorithms.shared_arrays import release
+from algorithms.progress import ProgressChannel
 import help_ui # Only needs to be initialized
 
 
@@ -19,12 +22,23 @@ ui.textarea.default_classes("w-full")
 # Validation
 IMAGE_FILE_TYPES = ('Image Files (*.png;*.tiff;*.bmp)',)
 
+# Previews
+PREVIEW_MAX_SIDE = 512 # Images are displayed at most about a third of the window wide
+PREVIEW_JPEG_QUALITY = 85
+PREVIEW_CACHE_SIZE = 32
+
 secret_text_validation = {'Secret text too long': lambda value: len(value) <= 100}
 im_filename_validation = {"Invalid file type, allowed: .png, .tiff, .bmp": lambda value: any(value.endswith(t) for t in (".png", ".tiff", ".bmp")) or not value}
 
 def im_filename_validation_func(filename):
     return all(validate(filename) for _, validate in im_filename_validation.items())
 
+# Algorithm pages of every connected client, their shared memory (progress channels, published block caches)
+# is released when the client is deleted or on shutdown
+open_pages = {}
+# Encoded previews by image content, so an image shown again (e.g. the same cover in another tab) is not encoded twice
+preview_cache = OrderedDict()
+
 # Helper functions
 def read_im(path):
     return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
@@ -32,10 +46,30 @@ def read_im(path):
 def write_im(path, im):
     cv2.imwrite(path, cv2.cvtColor(im, cv2.COLOR_BGR2RGB))
 
+def preview_source(im):
+    # Downscaled JPEG of the image as a data URL, the image itself stays in memory for saving
+    key = (hashlib.blake2b(im.data if im.flags.c_contiguous else im.tobytes(), digest_size=16).hexdigest(), im.shape)
+    if key in preview_cache:
+        preview_cache.move_to_end(key)
+        return preview_cache[key]
+
+    scale = PREVIEW_MAX_SIDE / max(im.shape[:2])
+    if scale < 1:
+        im = cv2.resize(im, (max(1, round(im.shape[1] * scale)), max(1, round(im.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    _, data = cv2.imencode(".jpg", cv2.cvtColor(im, cv2.COLOR_RGB2BGR), (cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY))
+    source = "data:image/jpeg;base64," + base64.b64encode(data).decode()
+
+    preview_cache[key] = source
+    if len(preview_cache) > PREVIEW_CACHE_SIZE:
+        preview_cache.popitem(last=False)
+    return source
+
 def set_im_ui(im_ui, im):
-    tmp_png_im_path = f"tmp/tmp_im_{random.randint(0, 100000)}.png"
-    write_im(tmp_png_im_path, im)
-    im_ui.set_source(tmp_png_im_path)
+    im_ui.set_source(preview_source(im))
+
+def eta_text(channel):
+    eta = channel.eta
+    return "" if eta is None else f"ETA: {eta:.1f} s"
 
 async def get_file(callback, file_types=None):
     if file_types == None:
@@ -53,6 +87,7 @@ class LSBHideAlg:
         self.generated_im = None
         self.hide_alg = hide_alg
         self.computing = False
+        self.progress = ProgressChannel()
         
         with ui.row().classes('w-full justify-center no-wrap'):
             with ui.column().classes('w-1/3'):
@@ -66,9 +101,11 @@ class LSBHideAlg:
                 self.generate_btn_ui = ui.button('generate stego image', on_click=self.generate_stego_image)
                 self.generate_btn_ui.disable()
                 self.generated_im_ui = ui.image("")
-                self.progressbar_ui = ui.linear_progress(show_value=False).props('query')
+                self.progressbar_ui = ui.linear_progress(value=0, show_value=False).props('instant-feedback'). \
+                    bind_value_from(self.progress, "fraction")
                 self.progressbar_ui.set_visibility(False)
                 self.blank_progressbar_ui = ui.linear_progress(show_value=False)
+                ui.label("").classes("text-xs text-gray-500").bind_text_from(self, "progress_eta_text")
                 self.filename_ui = ui.input(label='Result filename', validation=im_filename_validation, \
                                             on_change=self.update_save_btn).props('outlined')
                 self.save_btn_ui = ui.button('save stego image', on_click=self.save_image)
@@ -83,6 +120,10 @@ class LSBHideAlg:
         enabled = self.cover_im is not None and self.secret_im is not None and not self.computing
         self.generate_btn_ui.set_enabled(enabled)
     
+    @property
+    def progress_eta_text(self):
+        return eta_text(self.progress) if self.computing else ""
+
     def update_progressbar(self):
         self.progressbar_ui.set_visibility(self.computing)
         self.blank_progressbar_ui.set_visibility(not self.computing)
@@ -106,12 +147,12 @@ class LSBHideAlg:
 
     async def save_image(self):
         write_im(self.filename_ui.value, self.generated_im)
-        pathlib.Path(self.tmp_im_path).unlink(missing_ok=True)
         ui.notify(f"Saved image to {self.filename_ui.value}")
     
+    def close(self):
+        self.progress.close()
+
     def set_generated_im(self, im):
-        self.tmp_im_path = f"tmp/tmp_im_{random.randint(0, 100000)}.tiff"
-        write_im(self.tmp_im_path, im)
         self.generated_im = im
         set_im_ui(self.generated_im_ui, self.generated_im)
     
@@ -125,9 +166,11 @@ class LSBHideAlg:
         self.update_progressbar()
     
     async def generate_stego_image(self):
+        self.progress.reset()
         self.set_computing(True)
         self.clear_generated_im()
-        result_im = await run.cpu_bound(self.hide_alg, self.cover_im, self.secret_im, **self.opts.get_args())
+        result_im = await run.cpu_bound(self.hide_alg, self.cover_im, self.secret_im, **self.opts.get_args(), \
+                                        progress=self.progress.reporter())
         self.set_generated_im(result_im)
         self.set_computing(False)
 
@@ -138,6 +181,7 @@ class LSBRevealAlg:
         self.revealed_im = None
         self.reveal_alg = reveal_alg
         self.computing = False
+        self.progress = ProgressChannel()
         
         with ui.row().classes('w-full justify-center no-wrap'):
             with ui.column().classes('w-1/3'):
@@ -148,9 +192,11 @@ class LSBRevealAlg:
                 self.reveal_btn_ui = ui.button('reveal secret image', on_click=self.reveal_secret_image)
                 self.reveal_btn_ui.disable()
                 self.revealed_im_ui = ui.image("")
-                self.progressbar_ui = ui.linear_progress(show_value=False).props('instant-feedback query')
+                self.progressbar_ui = ui.linear_progress(value=0, show_value=False).props('instant-feedback'). \
+                    bind_value_from(self.progress, "fraction")
                 self.progressbar_ui.set_visibility(False)
                 self.blank_progressbar_ui = ui.linear_progress(show_value=False)
+                ui.label("").classes("text-xs text-gray-500").bind_text_from(self, "progress_eta_text")
                 self.filename_ui = ui.input(label='Result filename', validation=im_filename_validation, \
                                             on_change=self.update_save_btn).props('outlined')
                 self.save_btn_ui = ui.button('save revealed image', on_click=self.save_image)
@@ -165,6 +211,10 @@ class LSBRevealAlg:
         enabled = self.stego_im is not None and not self.computing
         self.reveal_btn_ui.set_enabled(enabled)
     
+    @property
+    def progress_eta_text(self):
+        return eta_text(self.progress) if self.computing else ""
+
     def update_progressbar(self):
         self.progressbar_ui.set_visibility(self.computing)
         self.blank_progressbar_ui.set_visibility(not self.computing)
@@ -180,12 +230,12 @@ class LSBRevealAlg:
 
     async def save_image(self):
         write_im(self.filename_ui.value, self.revealed_im)
-        pathlib.Path(self.tmp_im_path).unlink(missing_ok=True)
         ui.notify(f"Saved image to {self.filename_ui.value}")
     
+    def close(self):
+        self.progress.close()
+
     def set_revealed_im(self, im):
-        self.tmp_im_path = f"tmp/tmp_im_{random.randint(0, 100000)}.tiff"
-        write_im(self.tmp_im_path, im)
         self.revealed_im = im
         set_im_ui(self.revealed_im_ui, self.revealed_im)
     
@@ -199,9 +249,10 @@ class LSBRevealAlg:
         self.update_progressbar()
 
     async def reveal_secret_image(self):
+        self.progress.reset()
         self.set_computing(True)
         self.clear_revealed_im()
-        result_im = await run.cpu_bound(self.reveal_alg, self.stego_im, **self.opts.get_args())
+        result_im = await run.cpu_bound(self.reveal_alg, self.stego_im, **self.opts.get_args(), progress=self.progress.reporter())
         self.set_revealed_im(result_im)
         self.set_computing(False)
 
@@ -212,10 +263,12 @@ class CoverlessHideAlg:
         self.blocks_dir = None
         self.generated_im = None
         self.blocks_computing = False
-        self.cache_progress_queue = Manager().Queue()
+        self.cache_progress = ProgressChannel()
         self.blocks_cache = None
+        self.blocks_cache_shms = []
+        self.closed = False
         self.computing = False
-        self.progress_queue = Manager().Queue()
+        self.progress = ProgressChannel()
         
         with ui.row().classes('w-full justify-center no-wrap'):
             with ui.column().classes('w-1/3'):
@@ -226,6 +279,7 @@ class CoverlessHideAlg:
                     bind_value_from(self, "cache_progress_bar_state")
                 self.chosen_blocks_dir_label_ui = ui.textarea(label='Selected blocks directory'). \
                     props('outlined readonly autogrow').bind_value_from(self, "blocks_dir")
+                self.cache_stats_ui = ui.label("").classes("text-xs text-gray-500")
             with ui.column().classes('w-1/3'):
                 ui.button('load secret text', on_click=self.choose_secret_text_file)
                 self.secret_text_ui = ui.textarea(label='Secret text', validation=secret_text_validation, \
@@ -236,6 +290,7 @@ class CoverlessHideAlg:
                 self.generated_im_ui = ui.image("")
                 self.progressbar_ui = ui.linear_progress(value=0, show_value=False).props('instant-feedback'). \
                     bind_value_from(self, "progress_bar_state")
+                ui.label("").classes("text-xs text-gray-500").bind_text_from(self, "progress_eta_text")
                 self.filename_ui = ui.input(label='Result filename', validation=im_filename_validation, \
                                             on_change=self.update_save_btn).props('outlined')
                 self.save_btn_ui = ui.button('save stego image', on_click=self.save_image)
@@ -244,14 +299,20 @@ class CoverlessHideAlg:
     @property
     def cache_progress_bar_state(self):
         if self.blocks_computing:
-            return self.cache_progress_queue.get_nowait() if not self.cache_progress_queue.empty() else self.cache_progressbar_ui.value
+            return self.cache_progress.fraction
         return 1 if self.blocks_cache else 0
     
     @property
     def progress_bar_state(self):
         if self.computing:
-            return self.progress_queue.get_nowait() if not self.progress_queue.empty() else self.progressbar_ui.value
+            return self.progress.fraction
         return 1 if self.generated_im is not None else 0
+
+    @property
+    def progress_eta_text(self):
+        if self.blocks_computing:
+            return eta_text(self.cache_progress)
+        return eta_text(self.progress) if self.computing else ""
     
     def update_save_btn(self):
         enabled = self.generated_im is not None and not self.computing and \
@@ -278,9 +339,29 @@ class CoverlessHideAlg:
     def set_blocks_dir(self, dir_path):
         self.blocks_dir = dir_path
 
+    def release_blocks_cache(self):
+        for shm in self.blocks_cache_shms:
+            release(shm, unlink=True)
+        self.blocks_cache_shms, self.blocks_cache = [], None
+
+    def set_blocks_cache(self, cache):
+        # Workers only receive the handle, the cache itself is published once
+        if self.closed:
+            return # Client left while the cache was built
+        self.release_blocks_cache()
+        self.blocks_cache_shms, self.blocks_cache = publish_block_cache(cache)
+        stats = cache.stats
+        self.cache_stats_ui.set_text(f"Cached blocks: {stats['blocks']} ({stats['fill_level']:.0%} full), evicted: {stats['evicted']}")
+
     async def choose_cover_im(self):
         await get_file(self.set_cover_im, file_types=IMAGE_FILE_TYPES)
 
+    def close(self):
+        self.closed = True
+        self.release_blocks_cache()
+        self.cache_progress.close()
+        self.progress.close()
+
     def set_blocks_computing(self, computing):
         self.blocks_computing = computing
         self.update_choose_blocks_btn()
@@ -288,22 +369,26 @@ class CoverlessHideAlg:
 
     async def choose_blocks_dir(self):
         await get_file(lambda f: self.set_blocks_dir(str(pathlib.Path(f).parent)))
+        self.closed = False # Page is in use, so its new cache is kept
+        self.cache_progress.reset()
         self.set_blocks_computing(True)
-        blocks_dir_filenames = [str(f) for f in pathlib.Path(self.blocks_dir).iterdir() if f.is_file()]
-        self.blocks_cache = await run.cpu_bound(build_block_cache, blocks_dir_filenames, self.cache_progress_queue)
-        self.set_blocks_computing(False)
+        try:
+            blocks_dir_filenames = [str(f) for f in pathlib.Path(self.blocks_dir).iterdir() if f.is_file()]
+            blocks_cache = await run.cpu_bound(build_block_cache, blocks_dir_filenames, self.cache_progress.reporter(), \
+                                               str(pathlib.Path(self.blocks_dir) / BLOCKS_CACHE_DIR), os.cpu_count(), \
+                                               BLOCKS_CACHE_MAX_BLOCKS)
+            self.set_blocks_cache(blocks_cache)
+        finally:
+            self.set_blocks_computing(False)
     
     async def choose_secret_text_file(self):
         await get_file(self.set_secret_text_file)
 
     async def save_image(self):
         write_im(self.filename_ui.value, self.generated_im)
-        pathlib.Path(self.tmp_im_path).unlink(missing_ok=True)
         ui.notify(f"Saved image to {self.filename_ui.value}")
 
     def set_generated_im(self, im):
-        self.tmp_im_path = f"tmp/tmp_im_{random.randint(0, 100000)}.tiff"
-        write_im(self.tmp_im_path, im)
         self.generated_im = im
         set_im_ui(self.generated_im_ui, self.generated_im)
     
@@ -316,9 +401,15 @@ class CoverlessHideAlg:
         self.update_generate_btn()
 
     async def generate_stego_image(self):
+        if self.blocks_cache is None:
+            ui.notify("Blocks cache was released, choose the blocks directory again")
+            self.update_generate_btn()
+            return
+        self.progress.reset()
         self.set_computing(True)
         self.clear_generated_im()
-        result_im = await run.cpu_bound(coverless_hide_data_wrapper, self.cover_im, self.secret_text_ui.value + "\0", self.blocks_cache, self.progress_queue)
+        result_im = await run.cpu_bound(coverless_hide_data_wrapper, self.cover_im, self.secret_text_ui.value, self.blocks_cache, \
+                                        self.progress.reporter())
         self.set_generated_im(result_im)
         self.set_computing(False)
 
@@ -380,8 +471,8 @@ class CoverlessRevealAlg:
     async def reveal_secret_text(self):
         self.set_computing(True)
         self.revealed_text = ""
-        result_text = await run.cpu_bound(get_message, self.stego_im)
-        self.revealed_text = result_text[:result_text.index("\\x00")]
+        result = await run.cpu_bound(get_message, self.stego_im)
+        self.revealed_text = result.decode(errors="replace")
         self.set_computing(False)
 
 
@@ -411,8 +502,13 @@ class VRLSBOptions:
         return {"alpha": int(self.alpha_ui.value), "max_p": int(self.max_p_ui.value)}
 
 
+def close_page(client_id):
+    for alg in open_pages.pop(client_id, []):
+        alg.close()
+
+
 @ui.page('/')
-def main_page():
+def main_page(client: Client):
     with ui.tabs().classes('w-full') as tabs:
         one = ui.tab('Basic LSB')
         two = ui.tab('Variable rate LSB')
@@ -422,36 +518,43 @@ def main_page():
         hide = ui.tab('Hide')
         reveal = ui.tab('Reveal')
 
+    algs = []
     with ui.tab_panels(tabs, value=one).classes('w-full'):
         with ui.tab_panel(one):
             with ui.tab_panels(tabs_mode, value=hide).classes('w-full'):
                 with ui.tab_panel(hide):
-                    LSBHideAlg(lsb_basic_hide_wrapper, BasicLSBOptions)
+                    algs.append(LSBHideAlg(lsb_basic_hide_wrapper, BasicLSBOptions))
                 with ui.tab_panel(reveal):
-                    LSBRevealAlg(lsb_basic_reveal_wrapper, BasicLSBOptions)
+                    algs.append(LSBRevealAlg(lsb_basic_reveal_wrapper, BasicLSBOptions))
         with ui.tab_panel(two):
             with ui.tab_panels(tabs_mode, value=hide).classes('w-full'):
                 with ui.tab_panel(hide):
-                    LSBHideAlg(lsb_vr_hide_wrapper, VRLSBOptions)
+                    algs.append(LSBHideAlg(lsb_vr_hide_wrapper, VRLSBOptions))
                 with ui.tab_panel(reveal):
-                    LSBRevealAlg(lsb_vr_reveal_wrapper, VRLSBOptions)
+                    algs.append(LSBRevealAlg(lsb_vr_reveal_wrapper, VRLSBOptions))
         with ui.tab_panel(three):
             with ui.tab_panels(tabs_mode, value=hide).classes('w-full'):
                 with ui.tab_panel(hide):
-                    CoverlessHideAlg()
+                    algs.append(CoverlessHideAlg())
                 with ui.tab_panel(reveal):
                     CoverlessRevealAlg()
     
     ui.button('Help', on_click=lambda: ui.open('/help')).classes("bottom-4 absolute", remove="w-full")
 
-    
-def on_startup():
-    pathlib.Path("tmp/").mkdir(parents=True, exist_ok=True)
+    # Every visit (also a return from /help) builds a new page, the previous one is released when its client is deleted.
+    # A websocket drop the browser reconnects from keeps the page. NiceGUI without on_delete calls the disconnect handlers
+    # only after the reconnect timeout, right before the client is deleted
+    open_pages[client.id] = algs
+    if hasattr(client, "on_delete"):
+        client.on_delete(lambda: close_page(client.id))
+    else:
+        client.on_disconnect(lambda: close_page(client.id))
 
+    
 def on_shutdown():
-    shutil.rmtree('tmp/', ignore_errors=True)
+    for client_id in list(open_pages):
+        close_page(client_id)
 
-app.on_startup(on_startup)
 app.on_shutdown(on_shutdown)
 
 ui.run(native=True, window_size=(1000, 800))